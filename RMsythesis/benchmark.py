@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+import argparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import astropy.io.fits as fits
+import astropy.constants as const
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import rmsynth
+import plotfdf
+
+# Benchmarks for the RM-synthesis scripts on synthetic data.
+#
+# Usage: python benchmark.py scaling --nx 256 --ny 256 --nchan 288 --workers 1 2 4 8
+#        python benchmark.py peaksearch --npix 4096
+#        python benchmark.py nufft --npix 256 --startPhi -2000
+#        python benchmark.py precision --npix 4096
+#        python benchmark.py suite --nx 128 --ny 128 --nchan 288 --nphi 8000
+
+#-----------------------------------------------------------------------------#
+# Write a synthetic set of wsclean-like Q/U channel images                    #
+#-----------------------------------------------------------------------------#
+# Every pixel holds a source with a random RM and amplitude plus Gaussian noise.
+# A fraction thickFraction of the sources are Faraday-thick: a uniform slab in
+# phi centred on the RM, of random width up to thickMax times the RMSF FWHM.
+# Returns the file lists, frequencies, the injected RM map and the width map
+# (0 for Faraday-thin sources).
+def make_channel_images(outdir, nx, ny, nchan, prefix="bench", fmin=800.0e6, fmax=1088.0e6,
+                        rmMax=300.0, noise=0.01, thickFraction=0.0, thickMax=0.2, seed=0):
+    rng = np.random.default_rng(seed)
+    freqs = np.linspace(fmin, fmax, nchan)
+    lamSqArr = np.power(const.c.value / freqs, 2.0)
+    fwhm = 2.0 * np.sqrt(3.0) / (np.max(lamSqArr) - np.min(lamSqArr))
+    rm = rng.uniform(-rmMax, rmMax, (ny, nx))
+    amp = rng.uniform(0.1, 1.0, (ny, nx))
+    width = rng.uniform(0.0, thickMax * fwhm, (ny, nx)) * (rng.random((ny, nx)) < thickFraction)
+
+    qlist = []
+    ulist = []
+    for chan in range(nchan):
+        # A slab of width w depolarises as sinc(w lambda^2)
+        P = amp * np.exp(2.0j * rm * lamSqArr[chan]) * np.sinc(width * lamSqArr[chan] / np.pi)
+        P += noise * (rng.normal(size=(ny, nx)) + 1.0j * rng.normal(size=(ny, nx)))
+        header = fits.Header()
+        header['CRVAL3'] = freqs[chan]
+        for stokes, plane, flist in (('Q', P.real, qlist), ('U', P.imag, ulist)):
+            fname = os.path.join(outdir, "%s-%04d-%s-image.fits" %(prefix, chan, stokes))
+            fits.writeto(fname, plane.astype(np.float32)[None,None], header, overwrite=True)
+            flist.append(fname)
+    return qlist, ulist, list(freqs), rm, width
+
+#-----------------------------------------------------------------------------#
+# Throughput of RMprocess against the number of workers                       #
+#-----------------------------------------------------------------------------#
+def bench_scaling(args):
+    workdir = tempfile.mkdtemp(prefix="rmsynth_bench_")
+    cwd = os.getcwd()
+    try:
+        print("Writing %dx%d synthetic cube with %d channels to %s" %(args.nx, args.ny, args.nchan, workdir))
+        qlist, ulist, freqs, rm, width = make_channel_images(workdir, args.nx, args.ny, args.nchan)
+        stopPhi = -args.startPhi + args.dPhi
+        os.chdir(workdir)
+        manifest = rmsynth.build_manifest("bench")
+
+        results = []
+        for workers in args.workers:
+            t0 = time.time()
+            rmsynth.RMprocess(manifest, args.startPhi, stopPhi, args.dPhi,
+                              rowsPerBlock=args.rows, workers=workers)
+            elapsed = time.time() - t0
+            results.append((workers, elapsed, args.nx * args.ny / elapsed))
+
+        print("")
+        print("%8s %10s %12s %8s" %("workers", "time (s)", "pixels/s", "speedup"))
+        for workers, elapsed, rate in results:
+            print("%8d %10.2f %12.1f %8.2f" %(workers, elapsed, rate, results[0][1] / elapsed))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+#-----------------------------------------------------------------------------#
+# Synthetic multi-component spectra                                           #
+#-----------------------------------------------------------------------------#
+# Each spectrum is the sum of up to nComp Faraday-thin components with random
+# amplitude, RM and intrinsic angle, plus Gaussian noise. Returns Q and U as
+# [npix, 1, nchan] arrays and the lambda^2 sampling.
+def make_spectra(npix, nchan, nComp=3, fmin=800.0e6, fmax=1088.0e6, rmMax=350.0, noise=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    freqs = np.linspace(fmin, fmax, nchan)
+    lamSqArr = np.power(const.c.value / freqs, 2.0)
+    P = np.zeros((npix, nchan), dtype='complex')
+    for comp in range(nComp):
+        amp = rng.uniform(0.0, 1.0, (npix, 1)) * (rng.random((npix, 1)) < 0.7)
+        rm = rng.uniform(-rmMax, rmMax, (npix, 1))
+        chi = rng.uniform(0.0, np.pi, (npix, 1))
+        P += amp * np.exp(2.0j * (chi + rm * lamSqArr))
+    P += noise * (rng.normal(size=P.shape) + 1.0j * rng.normal(size=P.shape))
+    dataQ = P.real.astype(np.float32).reshape(npix, 1, nchan)
+    dataU = P.imag.astype(np.float32).reshape(npix, 1, nchan)
+    return dataQ, dataU, lamSqArr
+
+#-----------------------------------------------------------------------------#
+# Check the coarse-to-fine peak search against the full phi grid              #
+#-----------------------------------------------------------------------------#
+def bench_peaksearch(args):
+    dataQ, dataU, lamSqArr = make_spectra(args.npix, args.nchan, nComp=args.ncomp)
+    phiArr = np.arange(args.startPhi, -args.startPhi + args.dPhi, args.dPhi)
+
+    t0 = time.time()
+    fdf = np.abs(rmsynth.do_rmsynth(dataQ, dataU, lamSqArr, phiArr))
+    peakFull = np.nanmax(fdf, axis=2)
+    valFull = phiArr[np.nanargmax(fdf, axis=2)]
+    tFull = time.time() - t0
+
+    t0 = time.time()
+    peakFast, valFast = rmsynth.find_peak(dataQ, dataU, lamSqArr, phiArr, oversample=args.oversample)
+    tFast = time.time() - t0
+
+    mismatch = np.count_nonzero(valFast != valFull)
+    print("full grid:      %8.2f s (%10.1f pixels/s)" %(tFull, args.npix / tFull))
+    print("coarse-to-fine: %8.2f s (%10.1f pixels/s)" %(tFast, args.npix / tFast))
+    print("speedup:        %8.2f" %(tFull / tFast))
+    print("RM mismatches:  %d/%d" %(mismatch, args.npix))
+    print("max |d peak|:   %g" %(np.max(np.abs(peakFast - peakFull))))
+    if mismatch > 0:
+        sys.exit("Coarse-to-fine peak search does not reproduce the full-grid result")
+
+#-----------------------------------------------------------------------------#
+# Accuracy and speed of the NUFFT engine against the direct sum               #
+#-----------------------------------------------------------------------------#
+def bench_nufft(args):
+    dataQ, dataU, lamSqArr = make_spectra(args.npix, args.nchan)
+    phiArr = np.arange(args.startPhi, -args.startPhi + args.dPhi, args.dPhi)
+    print("%d spectra, %d channels, %d phi samples" %(args.npix, args.nchan, phiArr.shape[0]))
+
+    t0 = time.time()
+    direct = rmsynth.do_rmsynth(dataQ, dataU, lamSqArr, phiArr, method='direct')
+    tDirect = time.time() - t0
+
+    t0 = time.time()
+    nufft = rmsynth.do_rmsynth(dataQ, dataU, lamSqArr, phiArr, method='nufft')
+    tNufft = time.time() - t0
+
+    err = np.max(np.abs(nufft - direct)) / np.max(np.abs(direct))
+    print("direct: %8.2f s (%10.1f pixels/s)" %(tDirect, args.npix / tDirect))
+    print("nufft:  %8.2f s (%10.1f pixels/s)" %(tNufft, args.npix / tNufft))
+    print("speedup:          %8.2f" %(tDirect / tNufft))
+    print("max relative error: %g" %(err))
+    print("RM mismatches:    %d/%d" %(np.count_nonzero(
+        np.argmax(np.abs(nufft), axis=2) != np.argmax(np.abs(direct), axis=2)), args.npix))
+
+#-----------------------------------------------------------------------------#
+# Single against double precision synthesis                                   #
+#-----------------------------------------------------------------------------#
+def bench_precision(args):
+    dataQ, dataU, lamSqArr = make_spectra(args.npix, args.nchan)
+    phiArr = np.arange(args.startPhi, -args.startPhi + args.dPhi, args.dPhi)
+    dPhi = phiArr[1] - phiArr[0]
+
+    failed = False
+    for method in ('direct', 'nufft'):
+        t0 = time.time()
+        double = rmsynth.do_rmsynth(dataQ, dataU, lamSqArr, phiArr, method=method, precision='double')
+        tDouble = time.time() - t0
+        t0 = time.time()
+        single = rmsynth.do_rmsynth(dataQ, dataU, lamSqArr, phiArr, method=method, precision='single')
+        tSingle = time.time() - t0
+
+        peakDouble = np.max(np.abs(double), axis=2)
+        peakSingle = np.max(np.abs(single), axis=2)
+        fdfErr = np.max(np.max(np.abs(single - double), axis=2) / peakDouble)
+        peakErr = np.max(np.abs(peakSingle - peakDouble) / peakDouble)
+        rmErr = np.max(np.abs(phiArr[np.argmax(np.abs(single), axis=2)] - phiArr[np.argmax(np.abs(double), axis=2)]))
+        print("%s: double %.2f s, single %.2f s, %d -> %d MB"
+              %(method, tDouble, tSingle, double.nbytes // 2**20, single.nbytes // 2**20))
+        print("    max |d FDF|/peak %.3g, max |d peak|/peak %.3g, max |d RM| %.3g (bound %.3g, %.3g, %.3g)"
+              %(fdfErr, peakErr, rmErr, rmsynth.SINGLE_FDF_TOL, rmsynth.SINGLE_FDF_TOL, dPhi))
+        if fdfErr >= rmsynth.SINGLE_FDF_TOL or peakErr >= rmsynth.SINGLE_FDF_TOL or rmErr > dPhi * (1 + 1e-6):
+            failed = True
+    if failed:
+        sys.exit("Single precision synthesis is outside the documented bound")
+
+#-----------------------------------------------------------------------------#
+# Per-stage timing and correctness of the whole stack on a synthetic cube     #
+#-----------------------------------------------------------------------------#
+# Peak resident memory of this process and its children, in MB
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return rss / 1024.0
+
+def bench_suite(args):
+    workdir = tempfile.mkdtemp(prefix="rmsynth_bench_")
+    cwd = os.getcwd()
+    npix = args.nx * args.ny
+    startPhi = -args.phimax
+    dPhi = 2.0 * args.phimax / args.nphi
+    stopPhi = -startPhi + dPhi
+    phiArr = np.arange(startPhi, stopPhi, dPhi)
+    times = {}
+    try:
+        print("Writing %dx%d synthetic cube with %d channels (%.0f%% Faraday-thick) to %s"
+              %(args.nx, args.ny, args.nchan, 100 * args.thick_fraction, workdir))
+        qlist, ulist, freqs, rm, width = make_channel_images(
+            workdir, args.nx, args.ny, args.nchan, rmMax=0.75 * args.phimax, thickFraction=args.thick_fraction)
+        os.chdir(workdir)
+        lamSqArr = np.power(const.c.value / np.array(freqs), 2.0)
+        fwhm = 2.0 * np.sqrt(3.0) / (np.max(lamSqArr) - np.min(lamSqArr))
+        print("%d phi samples, dPhi %.3g, RMSF FWHM %.3g rad/m^2" %(phiArr.shape[0], dPhi, fwhm))
+
+        t0 = time.time()
+        manifest = rmsynth.build_manifest("bench")
+        times['manifest'] = time.time() - t0
+
+        # Build the kernel in an empty cache
+        rmsynth.kernelCache = rmsynth.KernelCache()
+        t0 = time.time()
+        if args.method == 'direct':
+            rmsynth.kernelCache.kernel(lamSqArr, np.ones(lamSqArr.shape, dtype='float32'), phiArr,
+                                       rmsynth.complex_dtype(args.precision))
+        times['kernel'] = time.time() - t0
+
+        # The stages of RMprocess, one block of rows at a time
+        for stage in ('io', 'synthesis', 'peak', 'write'):
+            times[stage] = 0.0
+        cube = rmsynth.ChannelCube(manifest['qlist'], manifest['ulist'])
+        t0 = time.time()
+        rmsynth.create_fits_image('val.fits', cube.header, (args.ny, args.nx))
+        val = rmsynth.open_fits_image('val.fits')
+        times['write'] += time.time() - t0
+        sample = None
+        for y0 in range(0, args.ny, args.rows):
+            y1 = min(y0 + args.rows, args.ny)
+            t0 = time.time()
+            dataQ, dataU = cube.read(y0, y1)
+            t1 = time.time()
+            FDFcube = rmsynth.do_rmsynth(dataQ, dataU, lamSqArr, phiArr, method=args.method,
+                                         precision=args.precision)
+            t2 = time.time()
+            blockVal = phiArr[np.nanargmax(np.abs(FDFcube), axis=2)]
+            t3 = time.time()
+            val[y0:y1,:] = blockVal
+            val.flush()
+            t4 = time.time()
+            times['io'] += t1 - t0
+            times['synthesis'] += t2 - t1
+            times['peak'] += t3 - t2
+            times['write'] += t4 - t3
+            if sample is None:
+                sample = FDFcube.reshape(-1, phiArr.shape[0])[:args.clean].astype('complex')
+        cube.close()
+        del val
+
+        # RM-CLEAN of a sample of the spectra
+        RMSF, rmsfphi = rmsynth.getRMSF(freqs, startPhi * 2, stopPhi * 2 - dPhi, dPhi)
+        t0 = time.time()
+        plotfdf.findpeaks_batch(sample, phiArr, RMSF, 6.0)
+        times['clean'] = time.time() - t0
+
+        # The same through RMprocess, end to end
+        t0 = time.time()
+        rmsynth.RMprocess(manifest, startPhi, stopPhi, dPhi, rowsPerBlock=args.rows, workers=args.workers,
+                          method=args.method, precision=args.precision)
+        times['RMprocess'] = time.time() - t0
+        valProcess = fits.getdata('val.fits')
+
+        print("")
+        print("%-10s %10s %12s" %("stage", "time (s)", "pixels/s"))
+        for stage, elapsed in times.items():
+            n = sample.shape[0] if stage == 'clean' else npix
+            print("%-10s %10.3f %12.1f" %(stage, elapsed, n / elapsed if elapsed > 0 else np.inf))
+        print("peak RSS:  %10.1f MB" %(peak_rss()))
+
+        # Compare the recovered RMs with the injected ones
+        tolerance = max(0.1 * fwhm, dPhi)
+        failed = False
+        for label, select in (("thin", width == 0), ("thick", width > 0)):
+            if not np.any(select):
+                continue
+            err = np.abs(valProcess[select] - rm[select])
+            outliers = np.count_nonzero(err > tolerance)
+            print("%-5s sources: median |d RM| %.3g, max %.3g, %d/%d off by more than %.3g rad/m^2"
+                  %(label, np.median(err), np.max(err), outliers, err.shape[0], tolerance))
+            failed = failed or outliers > 0
+        if failed:
+            sys.exit("The recovered RMs do not match the injected ones")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for RM-synthesis")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    scaling = subparsers.add_parser("scaling", help="RMprocess throughput versus worker count")
+    scaling.add_argument("--nx", type=int, default=256)
+    scaling.add_argument("--ny", type=int, default=256)
+    scaling.add_argument("--nchan", type=int, default=288)
+    scaling.add_argument("--startPhi", type=float, default=-400.0)
+    scaling.add_argument("--dPhi", type=float, default=0.1)
+    scaling.add_argument("--rows", type=int, default=8)
+    scaling.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    scaling.set_defaults(func=bench_scaling)
+
+    peaksearch = subparsers.add_parser("peaksearch", help="coarse-to-fine peak search against the full grid")
+    peaksearch.add_argument("--npix", type=int, default=4096)
+    peaksearch.add_argument("--nchan", type=int, default=288)
+    peaksearch.add_argument("--ncomp", type=int, default=3)
+    peaksearch.add_argument("--startPhi", type=float, default=-400.0)
+    peaksearch.add_argument("--dPhi", type=float, default=0.1)
+    peaksearch.add_argument("--oversample", type=int, default=10)
+    peaksearch.set_defaults(func=bench_peaksearch)
+
+    nufft = subparsers.add_parser("nufft", help="NUFFT engine against the direct sum")
+    nufft.add_argument("--npix", type=int, default=256)
+    nufft.add_argument("--nchan", type=int, default=288)
+    nufft.add_argument("--startPhi", type=float, default=-2000.0)
+    nufft.add_argument("--dPhi", type=float, default=0.1)
+    nufft.set_defaults(func=bench_nufft)
+
+    precision = subparsers.add_parser("precision", help="single against double precision synthesis")
+    precision.add_argument("--npix", type=int, default=1024)
+    precision.add_argument("--nchan", type=int, default=288)
+    precision.add_argument("--startPhi", type=float, default=-400.0)
+    precision.add_argument("--dPhi", type=float, default=0.1)
+    precision.set_defaults(func=bench_precision)
+
+    suite = subparsers.add_parser("suite", help="per-stage timing and correctness on a synthetic cube")
+    suite.add_argument("--nx", type=int, default=64)
+    suite.add_argument("--ny", type=int, default=64)
+    suite.add_argument("--nchan", type=int, default=288)
+    suite.add_argument("--nphi", type=int, default=8000)
+    suite.add_argument("--phimax", type=float, default=400.0)
+    suite.add_argument("--thick-fraction", type=float, default=0.3)
+    suite.add_argument("--rows", type=int, default=16)
+    suite.add_argument("--workers", type=int, default=1)
+    suite.add_argument("--method", choices=["direct", "nufft"], default="direct")
+    suite.add_argument("--precision", choices=["double", "single"], default="double")
+    suite.add_argument("--clean", type=int, default=256, help="number of spectra to RM-CLEAN")
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
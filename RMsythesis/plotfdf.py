@@ -1,47 +1,14 @@
 #!/usr/bin/env python
+import argparse
+import glob
+import os
 import numpy as np
-import sys
 import matplotlib.pyplot as plt
+import astropy.constants as const
 
-# Perform RM-synthesis on Stokes Q and U data
-#
-# dataQ, dataU and freqs - contains the Q/U data at each frequency (in Hz) measured.
-# startPhi, dPhi - the starting RM (rad/m^2) and the step size (rad/m^2)
-def getFDF(dataQ, dataU, freqs, startPhi, stopPhi, dPhi, dType='float32'):
-    # Calculate the RM sampling
-    phiArr = np.arange(startPhi, stopPhi, dPhi)
-
-    # Calculate the frequency and lambda sampling
-    lamSqArr = np.power(2.99792458e8 / np.array(freqs), 2.0)
-
-    # Calculate the dimensions of the output RM cube
-    nPhi = len(phiArr)
-
-    # Initialise the complex Faraday Dispersion Function (FDF)
-    FDF = np.ndarray((nPhi), dtype='complex')
-
-    # Assume uniform weighting
-    wtArr = np.ones(len(lamSqArr), dtype=dType)
-
-    K = 1.0 / np.nansum(wtArr)
-
-    # Get the weighted mean of the LambdaSq distribution (B&dB Eqn. 32)
-    lam0Sq = K * np.nansum(lamSqArr)
-
-    # Mininize the number of inner-loop operations by calculating the
-    # argument of the EXP term in B&dB Eqns. (25) and (36) for the FDF
-    a = (-2.0 * 1.0j * phiArr)
-    b = (lamSqArr - lam0Sq) 
-    arg = np.exp( np.outer(a, b) )
-
-    # Create a weighted complex polarised surface-brightness cube
-    # i.e., observed polarised surface brightness, B&dB Eqns. (8) and (14)
-    Pobs = (np.array(dataQ) + 1.0j * np.array(dataU))
-
-    # Calculate the Faraday Dispersion Function
-    # B&dB Eqns. (25) and (36)
-    FDF = K * np.nansum(Pobs * arg, 1)
-    return FDF, phiArr
+# RM-synthesis on Stokes Q and U data, getFDF(..., method='direct' or 'nufft'),
+# and the RMSF, both sharing the kernel cache of rmsynth.py
+from rmsynth import getFDF, getRMSF, do_rmsynth
 
 def plotFDFAll(phi, FDFclean, title):
     fig = plt.figure()
@@ -72,9 +39,10 @@ def findpeaks(freqs, fdf, phi, rmsf, rmsfphi, nsigma):
     rmsflen = int((len(rmsf) - 1) / 2)
     fdflen = len(phi) + rmsflen
     while True:
-        std = np.std(np.abs(fdf))
-        peak1 = np.max(np.abs(fdf))
-        pos1 = np.argmax(np.abs(fdf))
+        absfdf = np.abs(fdf)
+        std = np.std(absfdf)
+        pos1 = np.argmax(absfdf)
+        peak1 = absfdf[pos1]
         val1 = phi[pos1]
         if peak1 < nsigma * std :
         	break
@@ -85,14 +53,42 @@ def findpeaks(freqs, fdf, phi, rmsf, rmsfphi, nsigma):
     fdf += np.convolve(components, Gauss, mode='valid')
     return phis, peaks, std
 
-def main():
-    # Expects input file in the format:
-    # freq(MHz),I(Jy),Q(Jy),U(Jy),V(Jy)
-    csvfile = sys.argv[1]
-    startPhi = -1000.0
-    dPhi     = 0.1
-    stopPhi = -startPhi+dPhi
-
+# RM-CLEAN many spectra at once, the same as findpeaks for each row of fdfs
+#
+# fdfs - [source, phi] FDFs sharing the same frequencies, cleaned in place.
+# The residuals are not restored with the clean beam.
+# Returns a list of phis, a list of peaks (one list per source) and the sigma of each source.
+def findpeaks_batch(fdfs, phi, rmsf, nsigma, maxiter=1000):
+    nsrc, nphi = fdfs.shape
+    rmsflen = int((len(rmsf) - 1) / 2)
+    peaks = [[] for n in range(nsrc)]
+    phis = [[] for n in range(nsrc)]
+    sigma = np.zeros(nsrc)
+
+    active = np.arange(nsrc)
+    for it in range(maxiter):
+        absfdf = np.abs(fdfs[active])
+        std = np.std(absfdf, axis=1)
+        pos = np.argmax(absfdf, axis=1)
+        peak = absfdf[np.arange(len(active)), pos]
+        sigma[active] = std
+
+        found = peak >= nsigma * std
+        active, pos, peak = active[found], pos[found], peak[found]
+        if len(active) == 0:
+            break
+
+        # Subtract the RMSF shifted to each peak
+        shifted = rmsf[(rmsflen - pos)[:,np.newaxis] + np.arange(nphi)]
+        fdfs[active] -= shifted * fdfs[active, pos][:,np.newaxis]
+        for n, p, pk in zip(active, pos, peak):
+            peaks[n].append(pk)
+            phis[n].append(phi[p])
+    return phis, peaks, sigma
+
+# Read one spectrum in the format:
+# freq(MHz),I(Jy),Q(Jy),U(Jy),V(Jy)
+def read_spectrum(csvfile):
     freqs = []
     i = []
     q = []
@@ -109,7 +105,36 @@ def main():
         q.append(float(data[2]))
         u.append(float(data[3]))
         v.append(float(data[4]))
-
+    return freqs, i, q, u, v
+
+# Read many spectra, either a directory of csv files in the format of
+# read_spectrum (the file name is the source ID) or a single table in the format:
+# source,freq(MHz),I(Jy),Q(Jy),U(Jy),V(Jy)
+# Returns a dictionary of source ID -> (freqs, i, q, u, v)
+def read_spectra(path):
+    spectra = {}
+    if os.path.isdir(path):
+        for csvfile in sorted(glob.glob(os.path.join(path, "*.csv"))):
+            source = os.path.splitext(os.path.basename(csvfile))[0]
+            spectra[source] = read_spectrum(csvfile)
+        return spectra
+
+    for line in open("%s" %(path)):
+        if len(line) < 2:
+            continue
+        if line[0] == "#":
+            continue
+        data = line.split(",")
+        if data[0] not in spectra:
+            spectra[data[0]] = ([], [], [], [], [])
+        for col, value in zip(spectra[data[0]], data[1:6]):
+            col.append(float(value))
+    for freqs, i, q, u, v in spectra.values():
+        freqs[:] = [f * 1.0e6 for f in freqs]
+    return spectra
+
+# RM parameters of a frequency setup
+def rm_parameters(freqs):
     # Work out the channel width
     df = []
     for f in range(1, len(freqs)):
@@ -126,16 +151,83 @@ def main():
     dphi = 2.0 * np.sqrt(3) / Dlambda2
     phiR = dphi / 5.0
     Nphi = 2 * phimax / phiR
-    print("Frequency range: %7.3f MHz - %7.3f MHz" %(fmin / 1.0e6, (fmin + bw) / 1.0e6))
-    print("Bandwidth: %7.3f MHz" %(bw / 1.0e6))
-    print("Channel width: %.1f KHz" %(chanBW / 1.0e3))
-    print("dlambda2: %7.3f" %(dlambda2))
-    print("Dlambda2: %7.3f" %(Dlambda2))
-    print("phimax: %7.3f" %(phimax))
-    print("dphi: %7.3f" %(dphi))
-    print("phiR: %7.3f" %(phiR))
-    print("Nphi: %7.3f" %(Nphi))
-    fwhm = dphi
+    return dict(fmin=fmin, bw=bw, chanBW=chanBW, dlambda2=dlambda2, Dlambda2=Dlambda2,
+                phimax=phimax, dphi=dphi, phiR=phiR, Nphi=Nphi)
+
+# RM-CLEAN every spectrum in path and write one row per component to outfile
+#
+# Spectra with the same frequencies are synthesised and cleaned together
+# in blocks of `blocksize`. Sources without a component get a single row
+# with NaN phi and peak.
+def batch(path, outfile, startPhi=-1000.0, dPhi=0.1, nsigma=6.0, blocksize=256):
+    stopPhi = -startPhi+dPhi
+    spectra = read_spectra(path)
+    print("Read %d spectra from %s" %(len(spectra), path))
+
+    # Group the sources by frequency setup
+    setups = {}
+    for source, spectrum in spectra.items():
+        setups.setdefault(tuple(spectrum[0]), []).append(source)
+
+    fp = open(outfile, "w")
+    fp.write("source,component,phi,phierr,peak,sigma,imean,fracpol\n")
+    for freqs, sources in setups.items():
+        fwhm = rm_parameters(freqs)["dphi"]
+        phi = np.arange(startPhi, stopPhi, dPhi)
+        lamSqArr = np.power(const.c.value / np.array(freqs), 2.0)
+        RMSF, rmsfphi = getRMSF(freqs, startPhi * 2, stopPhi * 2 - dPhi, dPhi)
+
+        for b0 in range(0, len(sources), blocksize):
+            block = sources[b0:b0+blocksize]
+            dataQ = np.array([spectra[source][2] for source in block])[:,np.newaxis,:]
+            dataU = np.array([spectra[source][3] for source in block])[:,np.newaxis,:]
+            fdfs = do_rmsynth(dataQ, dataU, lamSqArr, phi)[:,0,:]
+            phis, peaks, sigma = findpeaks_batch(fdfs, phi, RMSF, nsigma)
+
+            for n, source in enumerate(block):
+                imean = np.mean(np.array(spectra[source][1]))
+                if len(peaks[n]) == 0:
+                    fp.write("%s,0,nan,nan,nan,%g,%g,nan\n" %(source, sigma[n], imean))
+                for c, (pphi, peak) in enumerate(zip(phis[n], peaks[n])):
+                    phierr = fwhm / (2 * peak / sigma[n])
+                    fp.write("%s,%d,%g,%g,%g,%g,%g,%g\n"
+                             %(source, c + 1, pphi, phierr, peak, sigma[n], imean, peak / imean))
+    fp.close()
+    print("Results written to %s" %(outfile))
+
+def main():
+    parser = argparse.ArgumentParser(description="Plot the FDF of a spectrum, or RM-CLEAN many spectra")
+    parser.add_argument("csvfile", nargs="?", help="spectrum in the format freq(MHz),I(Jy),Q(Jy),U(Jy),V(Jy)")
+    parser.add_argument("--batch", default=None,
+                        help="directory of csv spectra, or a table of source,freq(MHz),I,Q,U,V")
+    parser.add_argument("--output", default="rmclean.csv", help="results table for --batch")
+    parser.add_argument("--nsigma", type=float, default=6.0, help="RM-CLEAN threshold")
+    args = parser.parse_args()
+
+    startPhi = -1000.0
+    dPhi     = 0.1
+    stopPhi = -startPhi+dPhi
+
+    if args.batch is not None:
+        batch(args.batch, args.output, startPhi, dPhi, args.nsigma)
+        return
+    if args.csvfile is None:
+        parser.error("a csv file or --batch is required")
+
+    csvfile = args.csvfile
+    freqs, i, q, u, v = read_spectrum(csvfile)
+
+    params = rm_parameters(freqs)
+    print("Frequency range: %7.3f MHz - %7.3f MHz" %(params["fmin"] / 1.0e6, (params["fmin"] + params["bw"]) / 1.0e6))
+    print("Bandwidth: %7.3f MHz" %(params["bw"] / 1.0e6))
+    print("Channel width: %.1f KHz" %(params["chanBW"] / 1.0e3))
+    print("dlambda2: %7.3f" %(params["dlambda2"]))
+    print("Dlambda2: %7.3f" %(params["Dlambda2"]))
+    print("phimax: %7.3f" %(params["phimax"]))
+    print("dphi: %7.3f" %(params["dphi"]))
+    print("phiR: %7.3f" %(params["phiR"]))
+    print("Nphi: %7.3f" %(params["Nphi"]))
+    fwhm = params["dphi"]
 
     # Determine the FDF using the q, u and ferquency values read from the file.
     dirty, phi = getFDF(q, u, freqs, startPhi, stopPhi, dPhi)
@@ -143,9 +235,9 @@ def main():
     plotFDFAll(phi, np.array(FDFqu), csvfile)
     rstartPhi = startPhi * 2
     rstopPhi = stopPhi * 2 - dPhi
-    RMSF, rmsfphi = getFDF(np.ones((len(q))), np.zeros((len(q))), freqs, rstartPhi, rstopPhi, dPhi)
+    RMSF, rmsfphi = getRMSF(freqs, rstartPhi, rstopPhi, dPhi)
 
-    phis, peaks, sigma = findpeaks(np.array(freqs), FDFqu, phi, RMSF, rmsfphi, 6.0)
+    phis, peaks, sigma = findpeaks(np.array(freqs), FDFqu, phi, RMSF, rmsfphi, args.nsigma)
     snr = peaks / sigma
     phierr = fwhm / (2 * snr)
     print (phis, phierr, peaks, sigma)
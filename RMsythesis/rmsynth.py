@@ -1,17 +1,138 @@
 #!/usr/bin/env python
+import argparse
+import collections
 import glob
+import hashlib
+import json
 import os
 import sys
+import time
+import multiprocessing
+import multiprocessing.pool
 import numpy as np
 import astropy.wcs as wcs
 import astropy.io.fits as fits
 import astropy.constants as const
 
+#-----------------------------------------------------------------------------#
+# Cache of phase kernels and RMSFs keyed by the frequency setup               #
+#-----------------------------------------------------------------------------#
+class KernelCache:
+    # In-memory LRU of the [chan, phi] kernels exp(-2i phi (lambda^2 - lambda0^2))
+    # and of RMSFs, keyed by a hash of (lambda^2, weights, phi grid, dtype).
+    #
+    # maxBytes - memory budget of the in-memory LRU
+    # cacheDir - optional directory of .npy files shared between runs and
+    #            processes; kernels found there are memory-mapped, not rebuilt
+    def __init__(self, maxBytes=2**30, cacheDir=None):
+        self.maxBytes = maxBytes
+        self.cacheDir = cacheDir
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind, lamSqArr, wtArr, phiArr, dtype):
+        h = hashlib.sha1(kind.encode())
+        for arr in (lamSqArr, wtArr, phiArr):
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        h.update(np.dtype(dtype).str.encode())
+        return h.hexdigest()
+
+    def _put(self, key, value):
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.maxBytes and len(self.entries) > 1:
+            oldKey, oldValue = self.entries.popitem(last=False)
+            self.nbytes -= oldValue.nbytes
+
+    # Return the cached array for `key`, calling build() to create it on a miss
+    def get(self, key, build):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        path = None
+        if self.cacheDir is not None:
+            path = os.path.join(self.cacheDir, key + ".npy")
+            if os.path.exists(path):
+                self.hits += 1
+                value = np.load(path, mmap_mode='r')
+                self._put(key, value)
+                return value
+
+        self.misses += 1
+        value = build()
+        if path is not None:
+            # Write to a temporary name first so other processes never see a partial file
+            os.makedirs(self.cacheDir, exist_ok=True)
+            tmpPath = "%s.%d.tmp.npy" %(path[:-4], os.getpid())
+            np.save(tmpPath, value)
+            os.replace(tmpPath, path)
+        self._put(key, value)
+        return value
+
+    # [chan, phi] phase kernel for B&dB Eqns. (25) and (36)
+    def kernel(self, lamSqArr, wtArr, phiArr, dtype='complex'):
+        def build():
+            K = 1.0 / np.nansum(wtArr)
+            lam0Sq = K * np.nansum(lamSqArr)
+            b = (lamSqArr - lam0Sq)
+            return np.exp( np.outer(b, -2.0j * phiArr) ).astype(dtype)
+        return self.get(self.key('kernel', lamSqArr, wtArr, phiArr, dtype), build)
+
+    # RMSF - the FDF of a source with Q = 1, U = 0 in every channel
+    def rmsf(self, lamSqArr, wtArr, phiArr, dtype='complex'):
+        def build():
+            K = 1.0 / np.nansum(wtArr)
+            arg = self.kernel(lamSqArr, wtArr, phiArr, dtype)
+            return (K * np.dot(wtArr.astype(dtype), arg)).astype(dtype)
+        return self.get(self.key('rmsf', lamSqArr, wtArr, phiArr, dtype), build)
+
+kernelCache = KernelCache()
+
+# Complex dtype used for the whole synthesis chain
+#
+# precision - 'double' (complex128) or 'single' (complex64). In single precision
+# the phases are still computed in float64 and only rounded once. Against
+# double precision the FDF of each pixel then differs by less than
+# SINGLE_FDF_TOL times its peak, so the peak differs by less than that
+# fraction and the RM of the peak by at most one phi step (when neighbouring
+# samples are within the rounding error). benchmark.py precision checks this.
+SINGLE_FDF_TOL = 1e-5
+
+# Default memory budget (bytes) of the FDF synthesised at once by process_block
+FDF_CHUNK_BYTES = 256 * 1024**2
+
+def complex_dtype(precision):
+    if precision == 'double':
+        return np.complex128
+    if precision == 'single':
+        return np.complex64
+    sys.exit("Unknown precision '%s', use 'single' or 'double'" %(precision))
+
+# Use a directory to keep kernels between runs
+def set_kernel_cache_dir(cacheDir):
+    kernelCache.cacheDir = cacheDir
+
+# Calculate the RMSF for the frequencies in freqs (in Hz), sampled like getFDF
+def getRMSF(freqs, startPhi, stopPhi, dPhi, dType='float32'):
+    phiArr = np.arange(startPhi, stopPhi, dPhi)
+    lamSqArr = np.power(const.c.value / np.array(freqs), 2.0)
+    wtArr = np.ones(len(lamSqArr), dtype=dType)
+    return kernelCache.rmsf(lamSqArr, wtArr, phiArr), phiArr
+
 # Perform RM-synthesis on Stokes Q and U data
 #
 # dataQ, dataU and freqs - contains the Q/U data at each frequency (in Hz) measured.
 # startPhi, dPhi - the starting RM (rad/m^2) and the step size (rad/m^2)
-def getFDF(dataQ, dataU, freqs, startPhi, stopPhi, dPhi, dType='float32'):
+# method - 'direct' for the explicit sum, 'nufft' for the non-uniform FFT engine
+# precision - 'double' or 'single', see complex_dtype
+def getFDF(dataQ, dataU, freqs, startPhi, stopPhi, dPhi, dType='float32', method='direct',
+           precision='double'):
+    cType = complex_dtype(precision)
+
     # Calculate the RM sampling
     phiArr = np.arange(startPhi, stopPhi, dPhi)
 
@@ -22,7 +143,7 @@ def getFDF(dataQ, dataU, freqs, startPhi, stopPhi, dPhi, dType='float32'):
     nPhi = len(phiArr)
 
     # Initialise the complex Faraday Dispersion Function (FDF)
-    FDF = np.ndarray((nPhi), dtype='complex')
+    FDF = np.ndarray((nPhi), dtype=cType)
 
     # Assume uniform weighting
     wtArr = np.ones(len(lamSqArr), dtype=dType)
@@ -31,26 +152,582 @@ def getFDF(dataQ, dataU, freqs, startPhi, stopPhi, dPhi, dType='float32'):
 
     # Get the weighted mean of the LambdaSq distribution (B&dB Eqn. 32)
     lam0Sq = K * np.nansum(lamSqArr)
-
-    # Mininize the number of inner-loop operations by calculating the
-    # argument of the EXP term in B&dB Eqns. (25) and (36) for the FDF
-    a = (-2.0 * 1.0j * phiArr)
-    b = (lamSqArr - lam0Sq) 
-    arg = np.exp( np.outer(a, b) )
+    b = (lamSqArr - lam0Sq)
 
     # Create a weighted complex polarised surface-brightness cube
     # i.e., observed polarised surface brightness, B&dB Eqns. (8) and (14)
-    Pobs = (np.array(dataQ) + 1.0j * np.array(dataU))
+    Pobs = (np.array(dataQ) + 1.0j * np.array(dataU)).astype(cType)
+
+    if method == 'nufft':
+        Pobs[~np.isfinite(Pobs)] = 0.0
+        FDF = nufft_fdf(Pobs[np.newaxis,:], b, K, phiArr, dtype=cType)[0]
+        return FDF, phiArr
+    if method != 'direct':
+        sys.exit("getFDF: Unknown method '%s'" %(method))
+
+    # Mininize the number of inner-loop operations by calculating the
+    # argument of the EXP term in B&dB Eqns. (25) and (36) for the FDF.
+    # The [chan, phi] kernel is shared by every call with the same setup.
+    arg = kernelCache.kernel(lamSqArr, wtArr, phiArr, cType)
 
     # Calculate the Faraday Dispersion Function
-    # B&dB Eqns. (25) and (36)
-    FDF = K * np.nansum(Pobs * arg, 1)
+    # B&dB Eqns. (25) and (36), NaN channels dropped as in a nansum
+    Pobs[~np.isfinite(Pobs)] = 0.0
+    FDF = K * np.dot(Pobs, arg)
     return FDF, phiArr
 
+#-----------------------------------------------------------------------------#
+# Non-uniform FFT engine for the FDF                                          #
+#-----------------------------------------------------------------------------#
+# Smallest 5-smooth integer >= n
+def _fft_size(n):
+    best = 2 * n
+    p2 = 1
+    while p2 < best:
+        p3 = p2
+        while p3 < best:
+            p5 = p3
+            while p5 < n:
+                p5 *= 5
+            best = min(best, p5)
+            p3 *= 3
+        p2 *= 2
+    return best
+
+# Evaluate FDF(phi) = K * sum_j Pobs_j exp(-2i phi b_j) on the uniform grid
+# phiArr for non-uniformly sampled b = lambda^2 - lambda0^2, without building
+# the [phi, chan] kernel. This is a type-1 NUFFT using Gaussian gridding
+# (Greengard & Lee 2004): with phi_k = phi_0 + k dPhi the sum becomes
+# sum_j c_j exp(i k x_j) with x_j = -2 dPhi b_j, which is spread onto a 2x
+# oversampled uniform grid with a Gaussian, FFTed and deconvolved.
+#
+# Pobs - [pixel, chan] spectra with no NaNs, eps - target relative accuracy,
+# dtype - complex dtype of the gridding, FFT and output.
+# Returns the [pixel, phi] FDF. Cost is O(nchan*log(1/eps) + nPhi*log(nPhi))
+# per pixel instead of O(nchan*nPhi).
+def nufft_fdf(Pobs, b, K, phiArr, eps=1e-10, dtype='complex'):
+    nPix, nChan = Pobs.shape
+    nPhi = phiArr.shape[0]
+    dPhi = phiArr[1] - phiArr[0] if nPhi > 1 else 1.0
+
+    # Centre the modes on k = 0 to keep the deconvolution well conditioned
+    kShift = nPhi // 2
+    modes = np.arange(nPhi) - kShift
+
+    # Oversampled grid (at least 2x, of a size the FFT handles quickly),
+    # Gaussian width and spreading half-width
+    nGrid = _fft_size(2 * nPhi)
+    nSpread = int(np.ceil(-np.log(eps) / (0.75 * np.pi))) + 1
+    tau = np.pi * nSpread / (3.0 * nPhi**2)
+    hGrid = 2.0 * np.pi / nGrid
+
+    # Non-uniform points on [0, 2pi) and their strengths
+    x = -2.0 * dPhi * b
+    c = (Pobs * np.exp(-2.0j * phiArr[0] * b) * np.exp(1.0j * kShift * x)).astype(dtype)
+    x = np.mod(x, 2.0 * np.pi)
+
+    # Gaussian spreading weights, identical for every pixel
+    offsets = np.arange(-nSpread + 1, nSpread + 1)
+    m = np.floor(x / hGrid).astype(int)[:,np.newaxis] + offsets
+    weights = np.exp(-(m * hGrid - x[:,np.newaxis])**2 / (4.0 * tau))
+    target = np.mod(m, nGrid).ravel()
+
+    # Sum the contributions landing on the same grid cell
+    order = np.argsort(target, kind='stable')
+    target = target[order]
+    starts = np.concatenate(([0], np.nonzero(np.diff(target))[0] + 1))
+    cells = target[starts]
+    weights = weights.ravel()[order]
+    chan = np.repeat(np.arange(nChan), offsets.shape[0])[order]
+
+    FDF = np.zeros((nPix, nPhi), dtype=dtype)
+    deconv = (K * np.sqrt(np.pi / tau) * np.exp(tau * modes**2)).astype(np.finfo(dtype).dtype)
+    weights = weights.astype(deconv.dtype)
+    # Keep the [pixel, chan*spread] contributions to a few hundred MB
+    chunk = max(1, int(2**24 // max(nChan * offsets.shape[0], nGrid)))
+    for p0 in range(0, nPix, chunk):
+        grid = np.zeros((min(chunk, nPix - p0), nGrid), dtype=dtype)
+        grid[:,cells] = np.add.reduceat(c[p0:p0+chunk][:,chan] * weights, starts, axis=1)
+        FDF[p0:p0+chunk] = deconv * np.fft.ifft(grid, axis=1)[:,np.mod(modes, nGrid)]
+    return FDF
+
+#-----------------------------------------------------------------------------#
+# Read the per-channel Q/U images as a single cube                            #
+#-----------------------------------------------------------------------------#
+class ChannelCube:
+    # Open (and memory-map) every Q and U channel image once.
+    #
+    # qlist, ulist - the per-channel Stokes Q and U FITS files, in frequency order.
+    # stokesI - optional Stokes I MFS image matching the channel images
+    def __init__(self, qlist, ulist, stokesI=None):
+        if len(qlist) != len(ulist):
+            sys.exit("ChannelCube: Channel count mismatch")
+        self.nchan = len(qlist)
+        self.qhdulists = [fits.open(qname, memmap=True) for qname in qlist]
+        self.uhdulists = [fits.open(uname, memmap=True) for uname in ulist]
+        self.qplanes = [hdulist[0].data for hdulist in self.qhdulists]
+        self.uplanes = [hdulist[0].data for hdulist in self.uhdulists]
+        self.header = self.qhdulists[0][0].header
+        self.ny, self.nx = self.qplanes[0].shape[-2:]
+        self.ihdulist = fits.open(stokesI, memmap=True) if stokesI is not None else None
+        self.iplane = self.ihdulist[0].data if stokesI is not None else None
+        if self.iplane is not None and self.iplane.shape[-2:] != (self.ny, self.nx):
+            sys.exit("ChannelCube: %s does not match the size of the Q/U images" %(stokesI))
+
+    # Index of rows y0:y1 of a plane, dropping any degenerate leading axes
+    def _rowslice(self, plane, y0, y1):
+        return (0,) * (plane.ndim - 2) + (slice(y0, y1), slice(None))
+
+    # Read rows y0:y1 of every channel, returned in spectral order [yxz]
+    def read(self, y0, y1):
+        nrows = y1 - y0
+        dataQ = np.zeros((self.nchan, nrows, self.nx), dtype=np.float32)
+        dataU = np.zeros((self.nchan, nrows, self.nx), dtype=np.float32)
+        # One contiguous read of nrows lines per channel plane
+        for chan in range(self.nchan):
+            dataQ[chan] = self.qplanes[chan][self._rowslice(self.qplanes[chan], y0, y1)]
+            dataU[chan] = self.uplanes[chan][self._rowslice(self.uplanes[chan], y0, y1)]
+
+        # Transpose XYZ into ZXY order (spectrum first)
+        # Remember Python ordering of arrays is reversed [zyx]
+        # Reorder [zyx] -> [yxz], i.e., [0,1,2] -> [1,2,0]
+        dataQ = np.ascontiguousarray(np.transpose(dataQ, (1,2,0)))
+        dataU = np.ascontiguousarray(np.transpose(dataU, (1,2,0)))
+        return dataQ, dataU
+
+    # Yield (y0, y1, dataQ, dataU) for blocks of rowsPerBlock rows,
+    # with dataQ/dataU shaped [rows, nx, nchan]
+    def blocks(self, rowsPerBlock=16):
+        for y0 in range(0, self.ny, rowsPerBlock):
+            y1 = min(y0 + rowsPerBlock, self.ny)
+            dataQ, dataU = self.read(y0, y1)
+            yield y0, y1, dataQ, dataU
+
+    # Read rows y0:y1 of the Stokes I image
+    def read_stokesI(self, y0, y1):
+        return np.array(self.iplane[self._rowslice(self.iplane, y0, y1)], dtype=np.float32)
+
+    def close(self):
+        for hdulist in self.qhdulists + self.uhdulists:
+            hdulist.close()
+        if self.ihdulist is not None:
+            self.ihdulist.close()
+
+#-----------------------------------------------------------------------------#
+# FITS images preallocated on disk and written through a memory map           #
+#-----------------------------------------------------------------------------#
+# Create a float32 FITS image of `shape` (python order) without writing the
+# data. The sky coordinates, beam and units are copied from `header`, `cards`
+# are appended (e.g. the WCS of extra axes).
+def create_fits_image(path, header, shape, cards=()):
+    newHeader = fits.Header([('SIMPLE', True), ('BITPIX', -32), ('NAXIS', len(shape))])
+    for axis, n in enumerate(shape[::-1]):
+        newHeader['NAXIS%d' %(axis + 1)] = n
+    celestial = wcs.WCS(header).celestial.to_header()
+    celestial.remove('WCSAXES', ignore_missing=True)
+    newHeader.extend(celestial, unique=True)
+    for key in ('BUNIT', 'BMAJ', 'BMIN', 'BPA'):
+        if key in header:
+            newHeader[key] = header[key]
+    newHeader.extend(cards, update=True)
+
+    headerStr = newHeader.tostring()
+    nbytes = int(np.prod(shape)) * 4
+    with open(path, 'wb') as fp:
+        fp.write(headerStr.encode('ascii'))
+        # Extend the file to the padded data size, the gap reads as zeros
+        fp.seek(len(headerStr) + ((nbytes + 2879) // 2880) * 2880 - 1)
+        fp.write(b'\0')
+
+# Memory-map the data of a FITS image written by create_fits_image
+def open_fits_image(path, mode='r+'):
+    header = fits.getheader(path)
+    shape = tuple(header['NAXIS%d' %(axis)] for axis in range(header['NAXIS'], 0, -1))
+    return np.memmap(path, dtype='>f4', mode=mode, offset=len(header.tostring()), shape=shape)
+
+# Create the FDF cube for RMprocess: |FDF| as [phi, y, x], or the complex FDF
+# as [real/imag, phi, y, x]
+def create_fdf_cube(path, header, phiArr, ny, nx, complexFDF=False):
+    cards = [('CTYPE3', 'FDEP'), ('CUNIT3', 'rad/m^2'), ('CRPIX3', 1.0),
+             ('CRVAL3', float(phiArr[0])), ('CDELT3', float(phiArr[1] - phiArr[0]))]
+    shape = (phiArr.shape[0], ny, nx)
+    if complexFDF:
+        cards += [('CTYPE4', 'COMPLEX'), ('CRPIX4', 1.0), ('CRVAL4', 1.0), ('CDELT4', 1.0),
+                  ('COMMENT', 'Axis 4: 1 - real part, 2 - imaginary part of the FDF')]
+        shape = (2,) + shape
+    create_fits_image(path, header, shape, cards)
+
+# Write the FDF of consecutive pixels in raster order, starting at pixel x of
+# row y, FDF in spectral order [pixel, phi]. Whole rows are written as one slice.
+def write_fdf_run(fdfOut, y, x, FDF):
+    nx = fdfOut.shape[-1]
+    p = 0
+    while p < FDF.shape[0]:
+        if x == 0 and FDF.shape[0] - p >= nx:
+            n = (FDF.shape[0] - p) // nx * nx
+            # Reorder [yxz] -> [zyx] to match the image order of the cube
+            block = np.transpose(FDF[p:p+n].reshape(n // nx, nx, -1), (2,0,1))
+            index = (slice(None), slice(y, y + n // nx), slice(None))
+        else:
+            n = min(nx - x, FDF.shape[0] - p)
+            block = FDF[p:p+n].T
+            index = (slice(None), y, slice(x, x + n))
+        if fdfOut.ndim == 4:
+            fdfOut[(0,) + index] = block.real
+            fdfOut[(1,) + index] = block.imag
+        else:
+            fdfOut[index] = np.abs(block)
+        p += n
+        y += (x + n) // nx
+        x = (x + n) % nx
+
+# Write the FDF of single pixels (ys, xs), FDF in spectral order [pixel, phi]
+def write_fdf_pixels(fdfOut, ys, xs, FDF):
+    FDF = FDF.T
+    if fdfOut.ndim == 4:
+        fdfOut[0][:,ys,xs] = FDF.real
+        fdfOut[1][:,ys,xs] = FDF.imag
+    else:
+        fdfOut[:,ys,xs] = np.abs(FDF)
+
+#-----------------------------------------------------------------------------#
+# Mask of the pixels worth synthesising                                       #
+#-----------------------------------------------------------------------------#
+# Pre-pass over a few planes: the pixels with finite data in the first, middle
+# or last channel and, if iThreshold is given, with a Stokes I (the MFS image
+# of the cube) >= iThreshold. Returns a [ny, nx] bool map.
+def build_pixel_mask(cube, iThreshold=None):
+    mask = np.zeros((cube.ny, cube.nx), dtype=bool)
+    for chan in sorted(set([0, cube.nchan // 2, cube.nchan - 1])):
+        dataQ = cube.qplanes[chan][cube._rowslice(cube.qplanes[chan], 0, cube.ny)]
+        dataU = cube.uplanes[chan][cube._rowslice(cube.uplanes[chan], 0, cube.ny)]
+        mask |= np.isfinite(dataQ) & np.isfinite(dataU)
+
+    if iThreshold is not None:
+        if cube.iplane is None:
+            sys.exit("build_pixel_mask: A Stokes I image is needed for iThreshold")
+        with np.errstate(invalid='ignore'):
+            mask &= (cube.read_stokesI(0, cube.ny) >= iThreshold)
+    return mask
+
+#-----------------------------------------------------------------------------#
+# Polarisation products derived from the FDF                                  #
+#-----------------------------------------------------------------------------#
+# Maps written by RMprocess with products=True, and their units
+PRODUCTS = [('noise', None), ('rmerr', 'rad/m^2'), ('pa0', 'deg'), ('peak2', None),
+            ('val2', 'rad/m^2'), ('fracpol', '')]
+
+# From a block of FDFs in spectral order [yxz], work out per pixel:
+# noise - the FDF noise, sqrt(<|F|^2>/2) over the wings further than noiseFwhm
+#         RMSF FWHMs from the peak
+# rmerr - the RM uncertainty fwhm / (2 peak / noise)
+# pa0 - the polarisation angle at the peak de-rotated to lambda^2 = 0 (deg)
+# peak2, val2 - the highest other local maximum, further than one FWHM from
+#               the peak, and its RM (NaN if there is none)
+# Returns the peak, its RM and a dictionary of the products, all shaped [y, x].
+def fdf_products(FDFcube, lamSqArr, phiArr, noiseFwhm=3.0):
+    fwhm = 2.0 * np.sqrt(3.0) / (np.nanmax(lamSqArr) - np.nanmin(lamSqArr))
+    lam0Sq = np.nanmean(lamSqArr)
+    nPhi = phiArr.shape[0]
+    fdf = np.abs(FDFcube)
+    index = np.nanargmax(fdf, axis=(2))
+    peak = np.take_along_axis(fdf, index[...,np.newaxis], axis=2)[...,0]
+    val = phiArr[index]
+    products = {}
+
+    # Noise from the wings of the FDF: the power outside the window of
+    # noiseFwhm FWHMs around the peak, from the cumulative power along phi
+    power = np.square(fdf, dtype=np.float64)
+    np.cumsum(power, axis=2, out=power)
+    lo = np.searchsorted(phiArr, val - noiseFwhm * fwhm, side='left')
+    hi = np.searchsorted(phiArr, val + noiseFwhm * fwhm, side='right')
+    inner = np.take_along_axis(power, (hi - 1)[...,np.newaxis], axis=2)[...,0]
+    inner -= np.where(lo > 0, np.take_along_axis(power, np.maximum(lo - 1, 0)[...,np.newaxis], axis=2)[...,0], 0.0)
+    nWings = nPhi - (hi - lo)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        noise = np.sqrt(np.maximum(power[...,-1] - inner, 0.0) / (2.0 * nWings))
+        products['noise'] = np.where(nWings > 0, noise, np.nan)
+        products['rmerr'] = fwhm / (2.0 * peak / products['noise'])
+
+    # Polarisation angle of the peak, wrapped to [-90, 90) deg
+    Fpeak = np.take_along_axis(FDFcube, index[...,np.newaxis], axis=2)[...,0]
+    chi0 = 0.5 * np.angle(Fpeak) - val * lam0Sq
+    products['pa0'] = np.degrees(np.mod(chi0 + np.pi / 2.0, np.pi) - np.pi / 2.0)
+
+    # Second peak: local maxima away from the main peak, searched in the
+    # buffer of the cumulative power which is no longer needed
+    isMax = np.zeros(fdf.shape, dtype=bool)
+    np.greater_equal(fdf[...,1:-1], fdf[...,:-2], out=isMax[...,1:-1])
+    isMax[...,1:-1] &= fdf[...,1:-1] >= fdf[...,2:]
+    lo = np.searchsorted(phiArr, val - fwhm, side='left')
+    hi = np.searchsorted(phiArr, val + fwhm, side='right')
+    phiIndex = np.arange(nPhi)
+    isMax &= (phiIndex < lo[...,np.newaxis]) | (phiIndex >= hi[...,np.newaxis])
+    candidates = power
+    candidates[...] = -np.inf
+    np.copyto(candidates, fdf, where=isMax)
+    index2 = np.argmax(candidates, axis=(2))
+    peak2 = np.take_along_axis(candidates, index2[...,np.newaxis], axis=2)[...,0]
+    found = np.isfinite(peak2)
+    products['peak2'] = np.where(found, peak2, np.nan)
+    products['val2'] = np.where(found, phiArr[index2], np.nan)
+    return peak, val, products
+
+#-----------------------------------------------------------------------------#
+# Process one block of rows into the output maps                              #
+#-----------------------------------------------------------------------------#
+# fdfOut - optional memory-mapped FDF cube, see create_fdf_cube
+# mask - optional [ny, nx] bool map of the pixels to synthesise, see build_pixel_mask
+# products - optional dictionary of memory-mapped maps of the fdf_products
+#            (and 'fracpol', the peak over the Stokes I of the cube), filled in the same pass
+# pThreshold - optionally, also skip pixels whose band-averaged |P| is below it
+# chunkBytes - memory budget of the FDF synthesised at once
+# Only the selected pixels are synthesised, the others are set to NaN. The
+# rows are read together, but synthesised in chunks of pixels whose FDF fits
+# in chunkBytes, so the memory does not grow with the image width or nPhi.
+def process_block(cube, y0, y1, lamSqArr, phiArr, peak, val, fdfOut=None, mask=None, products=None,
+                  fastPeak=False, method='direct', precision='double', pThreshold=None,
+                  chunkBytes=FDF_CHUNK_BYTES):
+    nrows = y1 - y0
+    outputs = dict(peak=peak, val=val)
+    if products is not None:
+        outputs.update(products)
+    if mask is not None and not np.any(mask[y0:y1]):
+        # Nothing to synthesise, the block is not even read
+        for out in outputs.values():
+            out[y0:y1,:] = np.nan
+        if fdfOut is not None:
+            fdfOut[...,y0:y1,:] = np.nan
+            fdfOut.flush()
+        return
+
+    dataQ, dataU = cube.read(y0, y1)
+
+    # Pack the selected pixels into a dense [pixel, 1, chan] work list
+    masked = mask is not None or pThreshold is not None
+    select = np.ones((nrows, cube.nx), dtype=bool) if mask is None else mask[y0:y1].copy()
+    if pThreshold is not None:
+        absP = np.hypot(dataQ, dataU)
+        nGood = np.sum(np.isfinite(absP), axis=2)
+        pMean = np.nansum(absP, axis=2) / np.maximum(nGood, 1)
+        select &= (nGood > 0) & (pMean >= pThreshold)
+    if masked:
+        dataQ = dataQ[select][:,np.newaxis,:]
+        dataU = dataU[select][:,np.newaxis,:]
+    else:
+        dataQ = dataQ.reshape(nrows * cube.nx, 1, cube.nchan)
+        dataU = dataU.reshape(nrows * cube.nx, 1, cube.nchan)
+    ys, xs = np.nonzero(select)
+    ys += y0
+    nPix = dataQ.shape[0]
+
+    if fdfOut is not None and masked:
+        # NaN for the whole block, then only the selected pixels are written
+        fdfOut[...,y0:y1,:] = np.nan
+
+    # Synthesise the work list in chunks of at most chunkBytes of FDF
+    chunk = max(1, int(chunkBytes // (phiArr.shape[0] * np.dtype(complex_dtype(precision)).itemsize)))
+    if not masked and chunk > cube.nx:
+        # Whole rows, written to the FDF cube as slices
+        chunk -= chunk % cube.nx
+    results = {name: np.empty(nPix) for name in outputs if name != 'fracpol'}
+    for p0 in range(0, nPix, chunk):
+        p1 = min(p0 + chunk, nPix)
+        chunkResults = _process_chunk(dataQ[p0:p1], dataU[p0:p1], lamSqArr, phiArr, ys[p0:p1], xs[p0:p1],
+                                      fdfOut, masked, products, fastPeak, method, precision)
+        for name, values in chunkResults.items():
+            results[name][p0:p1] = values
+
+    if products is not None and 'fracpol' in products:
+        dataI = cube.read_stokesI(y0, y1)[select]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            results['fracpol'] = results['peak'] / dataI
+
+    # Unpack the work list, the masked pixels are NaN
+    rows = np.full((nrows, cube.nx), np.nan, dtype=np.float32)
+    for name, out in outputs.items():
+        rows[select] = results[name]
+        out[y0:y1,:] = rows
+    if fdfOut is not None:
+        fdfOut.flush()
+
+# Synthesise one chunk of the work list of process_block, dataQ and dataU
+# shaped [pixel, 1, chan], and write its FDF to the pixels (ys, xs) of fdfOut
+# (consecutive pixels in raster order unless masked).
+# Returns the peak, its RM and the requested products, shaped [pixel].
+def _process_chunk(dataQ, dataU, lamSqArr, phiArr, ys, xs, fdfOut, masked, products, fastPeak, method,
+                   precision):
+    if fastPeak:
+        # Only search for the peak, without the full FDF
+        peak, val = find_peak(dataQ, dataU, lamSqArr, phiArr, precision=precision)
+        return dict(peak=peak[:,0], val=val[:,0])
+
+    # Run the RM-Synthesis routine on the data
+    # do_rmsynth returns a complex FDF cube in spectral order [yxz]
+    FDFcube = do_rmsynth(dataQ, dataU, lamSqArr, phiArr, method=method, precision=precision)
+    results = {}
+    if products is not None:
+        peak, val, derived = fdf_products(FDFcube, lamSqArr, phiArr)
+        results.update((name, derived[name][:,0]) for name in products if name in derived)
+    else:
+        fdf = np.abs(FDFcube)
+        peak = np.nanmax(fdf, axis=(2))
+        val = phiArr[np.nanargmax(fdf, axis=(2))]
+    results['peak'] = peak[:,0]
+    results['val'] = val[:,0]
+    if fdfOut is not None and masked:
+        write_fdf_pixels(fdfOut, ys, xs, FDFcube[:,0,:])
+    elif fdfOut is not None and len(ys) > 0:
+        write_fdf_run(fdfOut, ys[0], xs[0], FDFcube[:,0,:])
+    return results
+
+# Flush memory-mapped outputs to disk
+def _flush(*arrays):
+    for arr in arrays:
+        if isinstance(arr, np.memmap):
+            arr.flush()
+
+# State of a pool worker - its own ChannelCube and memory maps of the outputs
+_worker = {}
+
+def _init_worker(qlist, ulist, stokesI, lamSqArr, phiArr, mapPaths, productPaths, options, cacheDir,
+                 fdfCube, mask):
+    set_kernel_cache_dir(cacheDir)
+    _worker['cube'] = ChannelCube(qlist, ulist, stokesI)
+    _worker['fdfOut'] = open_fits_image(fdfCube) if fdfCube is not None else None
+    _worker['options'] = options
+    _worker['mask'] = mask
+    _worker['lamSqArr'] = lamSqArr
+    _worker['phiArr'] = phiArr
+    _worker['maps'] = [open_fits_image(path) for path in mapPaths]
+    _worker['products'] = None
+    if productPaths is not None:
+        _worker['products'] = {name: open_fits_image(path) for name, path in productPaths.items()}
+
+# Run one block in a pool worker. The maps are written in place through
+# shared memory maps, so only the block limits go back to the parent.
+def _worker_block(block):
+    y0, y1 = block
+    peak, val = _worker['maps']
+    process_block(_worker['cube'], y0, y1, _worker['lamSqArr'], _worker['phiArr'], peak, val,
+                  fdfOut=_worker['fdfOut'], mask=_worker['mask'], products=_worker['products'],
+                  **_worker['options'])
+    _flush(peak, val, *(_worker['products'] or {}).values())
+    return block
+
+#-----------------------------------------------------------------------------#
+# Manifest of the Q/U channel images                                          #
+#-----------------------------------------------------------------------------#
+# Header summary of one channel image, with the file size and mtime used to
+# tell if it changed since it was scanned
+def scan_channel_image(path):
+    stat = os.stat(path)
+    header = fits.getheader(path, 0)
+    beam = [header.get(key) for key in ('BMAJ', 'BMIN', 'BPA')]
+    return dict(path=path, size=stat.st_size, mtime=stat.st_mtime,
+                nx=int(header['NAXIS1']), ny=int(header['NAXIS2']),
+                freq=float(header['CRVAL3']), beam=beam if None not in beam else None)
+
+# Build the manifest of the wsclean channel images <prefix>-????-Q/U-image.fits
+#
+# The headers are scanned once, in parallel, and kept in indexFile (default
+# <prefix>-manifest.json); later calls only rescan the files whose size or mtime changed.
+# Returns a dictionary with the file lists (qlist, ulist), the channel frequencies
+# (freqs), the beams of the Q images (beams, None if not in the header) and the image size (nx, ny).
+def build_manifest(prefix, indexFile=None, threads=8):
+    if indexFile is None:
+        indexFile = "%s-manifest.json" %(prefix)
+    qlist = sorted(glob.glob("%s-????-Q-image.fits" %(prefix)))
+    ulist = sorted(glob.glob("%s-????-U-image.fits" %(prefix)))
+    if len(qlist) != len(ulist):
+        sys.exit("Channel count mismatch")
+    if len(qlist) == 0:
+        sys.exit("build_manifest: No channel images found for %s" %(prefix))
+
+    cached = {}
+    if os.path.exists(indexFile):
+        with open(indexFile) as fp:
+            cached = {entry['path']: entry for entry in json.load(fp)['files']}
+
+    # Only (re)scan the new and changed files
+    entries = {}
+    rescan = []
+    for path in qlist + ulist:
+        stat = os.stat(path)
+        entry = cached.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            entries[path] = entry
+        else:
+            rescan.append(path)
+    if len(rescan) > 0:
+        print("Scanning %d/%d channel headers" %(len(rescan), len(qlist) + len(ulist)))
+        with multiprocessing.pool.ThreadPool(max(1, min(threads, len(rescan)))) as pool:
+            for entry in pool.map(scan_channel_image, rescan):
+                entries[entry['path']] = entry
+        tmpPath = indexFile + ".tmp"
+        with open(tmpPath, 'w') as fp:
+            json.dump({'prefix': prefix, 'files': [entries[path] for path in qlist + ulist]}, fp)
+        os.replace(tmpPath, indexFile)
+
+    nx = entries[qlist[0]]['nx']
+    ny = entries[qlist[0]]['ny']
+    for qname, uname in zip(qlist, ulist):
+        qentry, uentry = entries[qname], entries[uname]
+        if qentry['nx'] != uentry['nx'] or qentry['ny'] != uentry['ny']:
+            sys.exit('Axis mismatch')
+        if qentry['nx'] != nx or qentry['ny'] != ny:
+            sys.exit('Axis mismatch')
+        if qentry['freq'] != uentry['freq']:
+            sys.exit("Channel frequency mismatch")
+
+    return dict(prefix=prefix, nx=nx, ny=ny, qlist=qlist, ulist=ulist,
+                freqs=[entries[qname]['freq'] for qname in qlist],
+                beams=[entries[qname]['beam'] for qname in qlist])
+
+#-----------------------------------------------------------------------------#
+# Checkpoint of the row blocks completed by RMprocess                         #
+#-----------------------------------------------------------------------------#
+# Load the blocks already done by a run with the same settings
+def load_checkpoint(path, settings):
+    if not os.path.exists(path):
+        return []
+    with open(path) as fp:
+        checkpoint = json.load(fp)
+    if checkpoint['settings'] != settings:
+        sys.exit("RMprocess: %s was written with different settings, can not resume" %(path))
+    return [tuple(block) for block in checkpoint['done']]
+
+# Record the completed blocks, replacing the file atomically
+def save_checkpoint(path, settings, done):
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'w') as fp:
+        json.dump({'settings': settings, 'done': sorted(done)}, fp)
+    os.replace(tmpPath, path)
+
 #-----------------------------------------------------------------------------#
 # Main control function                                                       #
 #-----------------------------------------------------------------------------#
-def RMprocess(qlist, ulist, qfreq, nx, ny, startPhi, stopPhi, dPhi):
+#
+# manifest - the channel images, as returned by build_manifest
+# fdfCube - optional FITS file to stream the FDF cube into, as it is produced
+# fdfComplex - write the complex FDF to fdfCube instead of |FDF|
+# checkpoint - sidecar file recording the completed row blocks
+# resume - skip the blocks recorded in checkpoint by an interrupted run
+# useMask - only synthesise the pixels selected by build_pixel_mask (and
+#           pThreshold), the others are set to NaN. Implied by iThreshold or pThreshold.
+# stokesI - Stokes I MFS image, for iThreshold and the fractional polarisation
+# iThreshold - minimum Stokes I of the pixels to synthesise
+# pThreshold - minimum band-averaged |P| of the pixels to synthesise
+# products - also write the maps of fdf_products (and fracpol.fits with stokesI)
+#            from the same pass, as <name>.fits
+# chunkBytes - memory budget of the FDF synthesised at once by each worker,
+#              rowsPerBlock only sets how many rows are read together
+def RMprocess(manifest, startPhi, stopPhi, dPhi, rowsPerBlock=16, workers=1,
+              fastPeak=False, method='direct', precision='double', fdfCube=None, fdfComplex=False,
+              checkpoint='rmsynth_checkpoint.json', resume=False, useMask=False, stokesI=None,
+              iThreshold=None, pThreshold=None, products=False, chunkBytes=FDF_CHUNK_BYTES):
+    qlist, ulist, qfreq = manifest['qlist'], manifest['ulist'], manifest['freqs']
+    nx, ny = manifest['nx'], manifest['ny']
     diff = []
     for f in range(1, len(qfreq)):
         diff.append(qfreq[f] - qfreq[f-1])
@@ -60,67 +737,105 @@ def RMprocess(qlist, ulist, qfreq, nx, ny, startPhi, stopPhi, dPhi):
     print("Channel separation = %f" %(df))
     print("Frequency range: %f-%f" %(np.min(qfreq), np.max(qfreq)))
 
-    # Allocate space for the data
-    peak = np.zeros((ny, nx), dtype=np.float32)
-    val = np.zeros((ny, nx), dtype=np.float32)
-
     # Generate the array of Phi values
     phiArr = np.arange(startPhi, stopPhi, dPhi)
 
     # Calculate the frequency and lambda sampling from the available frequencies
     lamArr_m = const.c.value / np.array(qfreq)
     lamSqArr_m2 = np.power(lamArr_m, 2.0)
-    header = None
-    for y in range(ny):
-        print("Processing line %d/%d" %(y, ny))
-        # Allocate space for the data
-        dataQ = np.zeros((nchan, 1, nx), dtype=np.float32)
-        dataU = np.zeros((nchan, 1, nx), dtype=np.float32)
-
-        for chan in range(nchan):
-            qhdulist = fits.open(qlist[chan], memmap=True)
-            if chan == 0:
-                header = qhdulist[0].header
-            dataQ[chan, 0, :] = qhdulist[0].data[0,0,y,:]
-            qhdulist.close()
-            uhdulist = fits.open(ulist[chan], memmap=True)
-            dataU[chan, 0, :] = uhdulist[0].data[0,0,y,:]
-            uhdulist.close()
 
-        # Transpose XYZ into ZXY order (spectrum first)
-        # Remember Python ordering of arrays is reversed [zyx]
-        # Reorder [zyx] -> [yxz], i.e., [0,1,2] -> [1,2,0]
-        dataQ = np.transpose(dataQ, (1,2,0))
-        dataU = np.transpose(dataU, (1,2,0))
+    # Open all channel images once and read them a block of rows at a time
+    cube = ChannelCube(qlist, ulist, stokesI)
+    header = cube.header
+    blocks = [(y0, min(y0 + rowsPerBlock, ny)) for y0 in range(0, ny, rowsPerBlock)]
+    options = dict(fastPeak=fastPeak, method=method, precision=precision, pThreshold=pThreshold)
+    if fdfCube is not None and fastPeak:
+        sys.exit("RMprocess: The FDF cube needs the full phi grid, it can not be used with fastPeak")
+    if products and fastPeak:
+        sys.exit("RMprocess: The derived products need the full phi grid, they can not be used with fastPeak")
 
-        # Run the RM-Synthesis routine on the data
-        # Currently assume 3-dimensions in do_rmsynth function
-        # do_rmsynth returns a complex FDF cube in spectral order [yxz]
-        print(" Running RM-Synthesis routine ...")
-        FDFcube = do_rmsynth(dataQ, dataU, lamSqArr_m2, phiArr)
+    # Everything that has to match for the outputs of a run to be resumed
+    settings = dict(qlist=list(qlist), ulist=list(ulist), nx=nx, ny=ny, startPhi=startPhi,
+                    stopPhi=stopPhi, dPhi=dPhi, rowsPerBlock=rowsPerBlock, fdfCube=fdfCube,
+                    fdfComplex=fdfComplex, useMask=useMask, stokesI=stokesI, iThreshold=iThreshold,
+                    products=products, **options)
+    # The chunk size does not change the outputs
+    options['chunkBytes'] = chunkBytes
+    done = load_checkpoint(checkpoint, settings) if resume else []
+    todo = [block for block in blocks if block not in done]
+    if len(done) > 0:
+        print("Resuming: %d/%d blocks already done" %(len(done), len(blocks)))
 
-        # Transpose the data back into image order [yxz] -> [zyx] ([012] -> [201])
-        FDFcube = np.transpose(FDFcube, (2,0,1))
+    # The peak polarised flux and the RM at which it occurs are written in place
+    # into preallocated FITS files, which also serve as the shared memory of the workers
+    mapPaths = ['peak.fits', 'val.fits']
+    productPaths = None
+    if products:
+        productPaths = {name: '%s.fits' %(name) for name, unit in PRODUCTS
+                        if name != 'fracpol' or stokesI is not None}
+    if len(done) == 0:
+        for path in mapPaths:
+            create_fits_image(path, header, (ny, nx))
+        for name, unit in PRODUCTS:
+            if productPaths is not None and name in productPaths:
+                cards = [('BUNIT', unit)] if unit is not None else []
+                create_fits_image(productPaths[name], header, (ny, nx), cards)
+        # Preallocate the FDF cube on disk, every block is written into it in place
+        if fdfCube is not None:
+            create_fdf_cube(fdfCube, header, phiArr, ny, nx, fdfComplex)
+        save_checkpoint(checkpoint, settings, done)
+    peak, val = [open_fits_image(path) for path in mapPaths]
+    productMaps = None
+    if productPaths is not None:
+        productMaps = {name: open_fits_image(path) for name, path in productPaths.items()}
 
-        fdf = np.abs(FDFcube)
-        peak[y,:] = np.nanmax(fdf, axis=(0))
-        val[y,:] = phiArr[np.nanargmax(fdf, axis=(0))]
-        if (y % 100) == 0: # Do a partial write every 100 lines.
-            # Write the peak polarised flux derived from the RM cube
-            fits.writeto('peak.fits', peak, header, overwrite=True, output_verify='ignore')
-            # Write the RM at which the peak polarised flux occurs for each pixel in the RM cube
-            fits.writeto('val.fits', val, header, overwrite=True, output_verify='ignore')
+    # Pre-pass selecting the pixels to synthesise
+    mask = None
+    if useMask or iThreshold is not None or pThreshold is not None:
+        mask = build_pixel_mask(cube, iThreshold)
+        print("Synthesising at most %d/%d pixels" %(np.count_nonzero(mask), nx * ny))
+    fdfOut = open_fits_image(fdfCube) if fdfCube is not None else None
+
+    pool = None
+    try:
+        if workers > 1:
+            print("Running RM-Synthesis on %d workers ..." %(workers))
+            pool = multiprocessing.Pool(
+                workers, initializer=_init_worker,
+                initargs=(qlist, ulist, stokesI, lamSqArr_m2, phiArr, mapPaths, productPaths, options,
+                          kernelCache.cacheDir, fdfCube, mask)
+            )
+            results = pool.imap_unordered(_worker_block, todo)
+        else:
+            results = todo
+
+        t0 = time.time(); nrows = 0
+        for y0, y1 in results:
+            if workers <= 1:
+                print("Processing lines %d-%d/%d" %(y0, y1 - 1, ny))
+                process_block(cube, y0, y1, lamSqArr_m2, phiArr, peak, val, fdfOut=fdfOut, mask=mask,
+                              products=productMaps, **options)
+                _flush(peak, val, *(productMaps or {}).values())
+            # The block is on disk, record it
+            done.append((y0, y1))
+            save_checkpoint(checkpoint, settings, done)
+            nrows += y1 - y0
+            print("Done %d/%d blocks (%.1f lines/s)" %(len(done), len(blocks), nrows / (time.time() - t0)))
 
-    # Write the peak polarised flux derived from the RM cube
-    fits.writeto('peak.fits', peak, header, overwrite=True, output_verify='ignore')
-    # Write the RM at which the peak polarised flux occurs for each pixel in the RM cube
-    fits.writeto('val.fits', val, header, overwrite=True, output_verify='ignore')
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        cube.close()
 
 
 #-----------------------------------------------------------------------------#
 # Perform RM-synthesis on Stokes Q and U cubes                                #
 #-----------------------------------------------------------------------------#
-def do_rmsynth(dataQ, dataU, lamSqArr, phiArr, dType='float32'):
+def do_rmsynth(dataQ, dataU, lamSqArr, phiArr, dType='float32', method='direct', precision='double'):
+    cType = complex_dtype(precision)
 
     # Parse the weight argument
     wtArr = np.ones(lamSqArr.shape, dtype=dType)
@@ -137,71 +852,199 @@ def do_rmsynth(dataQ, dataU, lamSqArr, phiArr, dType='float32'):
     nX = dataQ.shape[1]
     nY = dataQ.shape[0]
     nPhi = phiArr.shape[0]
-
-    # Initialise the complex Faraday Dispersion Function (FDF) cube
-    # Remember, python index order is reversed [2,1,0] = [y,x,phy]
-    FDFcube = np.ndarray((nY, nX, nPhi), dtype='complex')
+    nChan = lamSqArr.shape[-1]
 
     # B&dB equations (24) and (38) give the inverse sum of the weights
     K = 1.0 / np.nansum(wtArr)
 
     # Get the weighted mean of the LambdaSq distribution (B&dB Eqn. 32)
     lam0Sq = K * np.nansum(lamSqArr)
-
-    # Mininize the number of inner-loop operations by calculating the
-    # argument of the EXP term in B&dB Eqns. (25) and (36) for the FDF
-    a = (-2.0 * 1.0j * phiArr)
-    b = (lamSqArr - lam0Sq) 
-    arg = np.exp( np.outer(a, b) )
+    b = (lamSqArr - lam0Sq)
 
     # Create a weighted complex polarised surface-brightness cube
     # i.e., observed polarised surface brightness, B&dB Eqns. (8) and (14)
-    # Weight-array will broadcast to the spectral dimension
-    PobsCube = (dataQ + 1.0j * dataU)
+    # Flatten the image to a [pixel, chan] matrix
+    PobsCube = (dataQ + 1.0j * dataU).astype(cType).reshape(nY * nX, nChan)
+
+    # Mask NaN channels per pixel. Zeroing them is equivalent to the nansum
+    # used by the per-pixel loop, and K is unchanged as the weights carry no NaNs.
+    PobsCube[~np.isfinite(PobsCube)] = 0.0
 
-    # Do the synthesis at each pixel of the image
-    for k in range(nY):
-        for i in range(nX):
-            # Calculate the Faraday Dispersion Function
-            # B&dB Eqns. (25) and (36)
-            FDFcube[k,i,:] = K * np.nansum(PobsCube[k,i,:] * arg, 1)
+    if method == 'nufft':
+        FDFcube = nufft_fdf(PobsCube, b, K, phiArr, dtype=cType)
+    elif method == 'direct':
+        # Mininize the number of inner-loop operations by calculating the
+        # argument of the EXP term in B&dB Eqns. (25) and (36) for the FDF.
+        # The kernel is laid out [chan, phi] so that a block of spectra can be
+        # multiplied against it directly, and is cached between blocks.
+        arg = kernelCache.kernel(lamSqArr, wtArr, phiArr, cType)
+
+        # Calculate the Faraday Dispersion Function for all pixels at once
+        # with a single matrix product, B&dB Eqns. (25) and (36)
+        FDFcube = K * np.dot(PobsCube, arg)
+    else:
+        sys.exit("do_rmsynth: Unknown method '%s'" %(method))
+
+    # Remember, python index order is reversed [2,1,0] = [y,x,phy]
+    FDFcube = FDFcube.reshape(nY, nX, nPhi)
 
     return FDFcube
 
+#-----------------------------------------------------------------------------#
+# Coarse-to-fine search for the peak of the FDF                               #
+#-----------------------------------------------------------------------------#
+# Evaluate the FDF of each pixel on windows of nWin consecutive phi samples
+#
+# Pobs - [pixel, chan] polarised spectra, start - [pixel, m] first index of
+# each window in the uniform grid phiArr. Returns [pixel, m, nWin].
+# Stepping along the window only multiplies by exp(-2i dPhi b), so the
+# window is one matrix product against a shared [chan, nWin] kernel.
+def _fdf_windows(Pobs, b, K, phiArr, start, nWin):
+    dPhi = phiArr[1] - phiArr[0]
+    step = np.exp( np.outer(b, -2.0j * dPhi * np.arange(nWin)) ).astype(Pobs.dtype)
+    base = Pobs[:,np.newaxis,:] * np.exp(-2.0j * phiArr[start][:,:,np.newaxis] * b).astype(Pobs.dtype)
+    return K * np.dot(base, step)
+
+# Find the peak of |FDF| over phiArr without evaluating the full grid.
+#
+# The FDF is first evaluated on a coarse grid with `oversample` samples per
+# RMSF FWHM. The `nCand` highest local maxima of each pixel are refined by
+# parabolic interpolation and then evaluated exactly on a window of the fine
+# grid around the interpolated position. Windows whose maximum lands on their
+# edge are moved until it does not, so the returned peak and RM are those of
+# the full-grid search whenever the global peak is one of the candidates.
+#
+# Returns peak, val in image order [yx]
+def find_peak(dataQ, dataU, lamSqArr, phiArr, oversample=10, nCand=3, dType='float32',
+              precision='double'):
+    cType = complex_dtype(precision)
+    nY, nX, nChan = dataQ.shape
+    nPhi = phiArr.shape[0]
+    dPhi = phiArr[1] - phiArr[0]
+
+    # Uniform weighting, as in do_rmsynth
+    wtArr = np.ones(lamSqArr.shape, dtype=dType)
+    K = 1.0 / np.nansum(wtArr)
+    lam0Sq = K * np.nansum(lamSqArr)
+    b = (lamSqArr - lam0Sq)
+
+    Pobs = (dataQ + 1.0j * dataU).astype(cType).reshape(nY * nX, nChan)
+    Pobs[~np.isfinite(Pobs)] = 0.0
+    nPix = Pobs.shape[0]
+
+    # Coarse grid tied to the RMSF FWHM (B&dB Eqn. 61)
+    fwhm = 2.0 * np.sqrt(3.0) / (np.nanmax(lamSqArr) - np.nanmin(lamSqArr))
+    stride = max(1, int(fwhm / (oversample * dPhi)))
+    coarseIdx = np.arange(0, nPhi, stride)
+    if coarseIdx[-1] != nPhi - 1:
+        coarseIdx = np.append(coarseIdx, nPhi - 1)
+    nCoarse = coarseIdx.shape[0]
+    arg = kernelCache.kernel(lamSqArr, wtArr, phiArr[coarseIdx], cType)
+    coarse = np.abs(K * np.dot(Pobs, arg))
+
+    # Candidate local maxima, best first
+    padded = np.pad(coarse, ((0,0),(1,1)), constant_values=-np.inf)
+    isMax = (coarse >= padded[:,:-2]) & (coarse >= padded[:,2:])
+    score = np.where(isMax, coarse, -np.inf)
+    nCand = min(nCand, nCoarse)
+    cand = np.argsort(-score, axis=1)[:,:nCand]
+
+    # Parabolic interpolation of |FDF| around each candidate
+    left = np.take_along_axis(padded, cand, axis=1)
+    mid = np.take_along_axis(coarse, cand, axis=1)
+    right = np.take_along_axis(padded, cand + 2, axis=1)
+    left = np.where(np.isfinite(left), left, mid)
+    right = np.where(np.isfinite(right), right, mid)
+    denom = left - 2.0 * mid + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(denom < 0, 0.5 * (left - right) / denom, 0.0)
+    offset = np.clip(offset, -1.0, 1.0)
+    centre = np.rint(coarseIdx[cand] + offset * stride).astype(int)
+
+    # Exact evaluation on a fine window around every candidate
+    nWin = min(2 * (stride // 2 + 2) + 1, nPhi)
+    halfWidth = nWin // 2
+    start = np.clip(centre - halfWidth, 0, nPhi - nWin)
+    fdf = np.abs(_fdf_windows(Pobs, b, K, phiArr, start, nWin)).reshape(nPix, nCand * nWin)
+    best = np.argmax(fdf, axis=1)
+    peak = fdf[np.arange(nPix), best]
+    bestIdx = start[np.arange(nPix), best // nWin] + best % nWin
+    pos = best % nWin
+
+    # Follow any window whose maximum sits on its edge
+    for i in range(nPhi // max(1, halfWidth) + 1):
+        edge = ((pos == 0) & (bestIdx > 0)) | ((pos == nWin - 1) & (bestIdx < nPhi - 1))
+        if not np.any(edge):
+            break
+        pix = np.nonzero(edge)[0]
+        start = np.clip(bestIdx[pix] - halfWidth, 0, nPhi - nWin)[:,np.newaxis]
+        fdf = np.abs(_fdf_windows(Pobs[pix], b, K, phiArr, start, nWin))[:,0,:]
+        best = np.argmax(fdf, axis=1)
+        newPeak = fdf[np.arange(pix.shape[0]), best]
+        pos[pix] = best
+        # Stop following windows that did not improve
+        improved = newPeak > peak[pix]
+        pos[pix[~improved]] = halfWidth
+        peak[pix[improved]] = newPeak[improved]
+        bestIdx[pix[improved]] = start[improved,0] + best[improved]
+
+    return peak.reshape(nY, nX), phiArr[bestIdx].reshape(nY, nX)
+
+# Defaults for the command line
 prefix = "pbeam20.1"        # Change this to whatever your "-name" setting was in wsclean
 startPhi = -400.0
 dPhi     = 0.1
-stopPhi = -startPhi+dPhi
-
-qlist = glob.glob("%s-????-Q-image.fits" %(prefix))
-qlist.sort()
-ulist = glob.glob("%s-????-U-image.fits" %(prefix))
-ulist.sort()
-
-if len(qlist) != len(ulist):
-    sys.exit("Channel count mismatch")
-
-qfreq = []
-nx = 0
-ny = 0
-for index in range(len(qlist)):
-    qheader = fits.getheader(qlist[index], 0)
-    uheader = fits.getheader(ulist[index], 0)
-    if index == 0:
-        nx = int(qheader['NAXIS1'])
-        ny = int(qheader['NAXIS2'])
-    else:
-        if qheader['NAXIS1'] != uheader['NAXIS1']:
-            sys.exit('Axis mismatch')
-        if qheader['NAXIS2'] != uheader['NAXIS2']:
-            sys.exit('Axis mismatch')
-        if qheader['NAXIS1'] != nx:
-            sys.exit('Axis mismatch')
-        if qheader['NAXIS2'] != ny:
-            sys.exit('Axis mismatch')
-    if qheader["CRVAL3"] != uheader["CRVAL3"]:
-        sys.exit("Channel frequency mismatch")
-    qfreq.append(float(qheader["CRVAL3"]))
 
-# RM-range to be searched and the step size
-RMprocess(qlist, ulist, qfreq, nx, ny, startPhi, stopPhi, dPhi)
+def main():
+    parser = argparse.ArgumentParser(description="RM-synthesis on wsclean Q/U channel images")
+    parser.add_argument("--prefix", default=prefix, help="the -name setting used in wsclean")
+    parser.add_argument("--startPhi", type=float, default=startPhi, help="starting RM (rad/m^2)")
+    parser.add_argument("--dPhi", type=float, default=dPhi, help="RM step size (rad/m^2)")
+    parser.add_argument("--rows", type=int, default=16, help="number of image rows read per block")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--chunk-mb", type=float, default=FDF_CHUNK_BYTES / 1024**2,
+                        help="memory budget (MB) of the FDF synthesised at once by each worker")
+    parser.add_argument("--fast-peak", action="store_true",
+                        help="coarse-to-fine peak search instead of the full phi grid")
+    parser.add_argument("--method", choices=["direct", "nufft"], default="direct",
+                        help="engine used to compute the FDF")
+    parser.add_argument("--precision", choices=["double", "single"], default="double",
+                        help="run the synthesis in complex128 or complex64")
+    parser.add_argument("--fdf-cube", default=None,
+                        help="also write the |FDF| cube to this FITS file")
+    parser.add_argument("--fdf-complex", action="store_true",
+                        help="write the complex FDF (real and imaginary planes) to --fdf-cube")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run, skipping the blocks it completed")
+    parser.add_argument("--mask", action="store_true",
+                        help="skip pixels without data (NaN borders), setting them to NaN")
+    parser.add_argument("--stokesI", default=None,
+                        help="Stokes I MFS image, for --i-threshold and the fractional polarisation")
+    parser.add_argument("--i-threshold", type=float, default=None,
+                        help="minimum Stokes I of the pixels to synthesise (with --stokesI)")
+    parser.add_argument("--p-threshold", type=float, default=None,
+                        help="minimum band-averaged |P| of the pixels to synthesise")
+    parser.add_argument("--products", action="store_true",
+                        help="also write the noise, RM error, de-rotated angle, second peak and fracpol maps")
+    parser.add_argument("--manifest", default=None,
+                        help="cached index of the channel headers (default <prefix>-manifest.json)")
+    parser.add_argument("--kernel-cache", default=None,
+                        help="directory for caching phase kernels between runs")
+    args = parser.parse_args()
+
+    if args.kernel_cache is not None:
+        set_kernel_cache_dir(args.kernel_cache)
+    stopPhi = -args.startPhi+args.dPhi
+
+    manifest = build_manifest(args.prefix, args.manifest)
+
+    # RM-range to be searched and the step size
+    RMprocess(manifest, args.startPhi, stopPhi, args.dPhi,
+              rowsPerBlock=args.rows, workers=args.workers, fastPeak=args.fast_peak, method=args.method,
+              precision=args.precision, fdfCube=args.fdf_cube, fdfComplex=args.fdf_complex,
+              resume=args.resume, useMask=args.mask, stokesI=args.stokesI,
+              iThreshold=args.i_threshold, pThreshold=args.p_threshold,
+              products=args.products, chunkBytes=int(args.chunk_mb * 1024**2))
+
+if __name__ == '__main__':
+    main()
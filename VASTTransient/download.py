@@ -4,20 +4,32 @@ from astropy.table import Table, Column
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
 from astropy import units as u
-from astropy.utils.data import clear_download_cache
 from astropy.stats import SigmaClip
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+from astropy.nddata import Cutout2D
 
 from astroquery.skyview import SkyView
 from astroquery.vizier import Vizier
 from astroquery.simbad import Simbad
 
+from .localcatalog import local_catalogs, query_catalog
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 import pkg_resources
 import requests
+import json
+import hashlib
+import fcntl
+import contextlib
+import warnings
+import shutil
 import threading
+import queue
+import time
 import io
 import os
 
@@ -102,6 +114,424 @@ def geturl_skymapper(ra, dec, radius):
         link = df.iloc[0].get_image
         return link
     
+### Shared store of downloaded archival images
+### native pixel scale (arcsec) of the surveys, finer cutouts of a survey are only resampled
+survey_pixscale = {
+    'SUMSS 843 MHz': 11., 'NVSS': 15., 'TGSS ADR1': 6.2, 'GLEAM 170-231 MHz': 28.,
+    'WISE 3.4': 1.375, 'WISE 4.6': 1.375, 'WISE 12': 1.375, 'WISE 22': 1.375,
+    '2MASS-J': 1., '2MASS-H': 1., '2MASS-K': 1., 'DSS': 1.7,
+    'PanSTARRS': 0.25, 'SkyMapper': 0.5,
+}
+
+def _cutout_width(survey, radius):
+    '''
+    Width (arcsec) of the image `download_archival` gets for a radius: PanSTARRS and SkyMapper
+    take it as the image size, SkyView as half of it
+    '''
+    if survey in ['PanSTARRS', 'SkyMapper']:
+        return radius
+    return 2 * radius
+
+def _expected_pixscale(survey, radius):
+    '''
+    Pixel scale (arcsec) of a freshly downloaded image, SkyView images have 300 pixels
+    '''
+    if survey in ['PanSTARRS', 'SkyMapper']:
+        return survey_pixscale[survey]
+    return max(_cutout_width(survey, radius) / 300., survey_pixscale.get(survey, 0.))
+
+def _cut_archival(imagepath, survey, ra, dec, radius, fitspath):
+    '''
+    Write the image `download_archival` would get for (ra, dec, radius) by cutting a larger image
+    '''
+    width = _cutout_width(survey, radius) * u.arcsec
+    with fits.open(imagepath) as hdulist:
+        header = hdulist[0].header.copy()
+        cutout = Cutout2D(
+            np.squeeze(hdulist[0].data), SkyCoord(ra, dec, unit=u.deg),
+            (width, width), wcs=WCS(header).celestial,
+        )
+    for key in list(header.keys()):
+        if key[:5] in ['NAXIS', 'CTYPE', 'CRVAL', 'CRPIX', 'CDELT', 'CUNIT', 'CROTA'] or key[:2] in ['CD', 'PC']:
+            header.remove(key, ignore_missing=True, remove_all=True)
+    header.update(cutout.wcs.to_header())
+    fits.writeto(fitspath, cutout.data, header, overwrite=True)
+
+class ArchiveStore:
+    '''
+    Store of downloaded archival images shared by all sources, indexed by their centre and half width.
+    A request falling fully inside a stored image of the same survey, with an adequate
+    pixel scale, is served by a cutout of that image instead of a download.
+    `download_archival` downloads images `1 + margin` times wider than requested (at the same
+    pixel scale) for the store, so requests up to about `margin` times the radius away are served.
+    The least recently used images are removed when the store grows over `maxbytes`
+    '''
+
+    def __init__(self, storedir, maxbytes=4*1024**3, margin=1.):
+        '''
+        Params:
+        ----------
+        storedir: str
+            folder of the stored images and their index (`index.json`)
+        maxbytes: int, 4GB by default
+            maximum size of the stored images
+        margin: float, 1 by default
+            extra width of the downloaded images, as a fraction of the requested width
+        '''
+        self.storedir = storedir
+        self.indexpath = os.path.join(storedir, 'index.json')
+        self.maxbytes = maxbytes
+        self.margin = margin
+        self.hits = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(storedir):
+            os.makedirs(storedir)
+        self._mtime = None
+        self.entries = self._load()
+
+    def _load(self):
+        ### also remember the version of the index, see `_refresh`
+        if not os.path.exists(self.indexpath):
+            return []
+        self._mtime = os.stat(self.indexpath).st_mtime_ns
+        with open(self.indexpath) as fp:
+            return json.load(fp)
+
+    def _save(self):
+        tmppath = f'{self.indexpath}.{os.getpid()}.tmp'
+        with open(tmppath, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.replace(tmppath, self.indexpath)
+        self._mtime = os.stat(self.indexpath).st_mtime_ns
+
+    def _refresh(self):
+        ### reload the index if another process changed it
+        try:
+            mtime = os.stat(self.indexpath).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            with self._locked():
+                self.entries = self._load()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        ### the index is shared by the threads of this process and by other processes
+        with self._lock:
+            with open(os.path.join(self.storedir, 'index.lock'), 'w') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _footprint(self, fitspath):
+        '''
+        Centre, half width (arcsec) and pixel scale (arcsec) of a fits image
+        '''
+        with fits.open(fitspath) as hdulist:
+            header = hdulist[0].header
+            wcs = WCS(header).celestial
+            ny, nx = hdulist[0].data.shape[-2:]
+
+        centre = wcs.pixel_to_world((nx - 1) / 2., (ny - 1) / 2.)
+        edges = wcs.pixel_to_world(
+            np.array([-0.5, nx - 0.5, (nx - 1) / 2., (nx - 1) / 2.]),
+            np.array([(ny - 1) / 2., (ny - 1) / 2., -0.5, ny - 0.5]),
+        )
+        halfwidth = np.min(centre.separation(edges).arcsec)
+        pixscale = np.mean(proj_plane_pixel_scales(wcs)) * 3600.
+        return float(centre.icrs.ra.deg), float(centre.icrs.dec.deg), float(halfwidth), float(pixscale)
+
+    def find(self, survey, ra, dec, radius):
+        '''
+        Find the stored image that can serve a request, i.e. the image of `survey`
+        with the finest pixel scale (but not finer than needed) that contains the whole request
+
+        Returns:
+        ----------
+        entry: dict or NoneType
+        '''
+        self._refresh()
+        entries = [entry for entry in self.entries if entry['survey'] == survey]
+        if len(entries) == 0:
+            return None
+
+        ### offsets (arcsec) of the request from the image centres, images are north up
+        ras = np.array([entry['ra'] for entry in entries])
+        decs = np.array([entry['dec'] for entry in entries])
+        dra = ((ra - ras + 180.) % 360. - 180.) * np.cos(np.radians(dec)) * 3600.
+        ddec = (dec - decs) * 3600.
+
+        ### the whole request (with one pixel of margin) has to be inside the image
+        halfwidth = _cutout_width(survey, radius) / 2.
+        required = _expected_pixscale(survey, radius) * 1.01
+        best = None
+        for i, entry in enumerate(entries):
+            limit = entry['halfwidth'] - entry['pixscale'] - halfwidth
+            if abs(dra[i]) > limit or abs(ddec[i]) > limit or entry['pixscale'] > required:
+                continue
+            if not os.path.exists(os.path.join(self.storedir, entry['path'])):
+                continue
+            if best is None or entry['pixscale'] > best['pixscale']:
+                best = entry
+        return best
+
+    def serve(self, survey, ra, dec, radius, fitspath):
+        '''
+        Write the cutout of a request to fitspath if a stored image contains it
+
+        Returns:
+        ----------
+        served: bool
+        '''
+        entry = self.find(survey, ra, dec, radius)
+        if entry is None:
+            return False
+
+        storepath = os.path.join(self.storedir, entry['path'])
+        try:
+            _cut_archival(storepath, survey, ra, dec, radius, fitspath)
+            os.utime(storepath)
+        except OSError: # removed by another process
+            return False
+        self.hits += 1
+        return True
+
+    def add(self, survey, fitspath):
+        '''
+        Copy a downloaded image into the store and index its footprint
+        '''
+        ra, dec, halfwidth, pixscale = self._footprint(fitspath)
+        storename = '{}_{:.5f}_{:+.5f}_{:.0f}.fits'.format(survey.replace(' ', '_'), ra, dec, halfwidth)
+        storepath = os.path.join(self.storedir, storename)
+        tmppath = f'{storepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.copyfile(fitspath, tmppath)
+        os.replace(tmppath, storepath)
+
+        with self._locked():
+            ### the index on disk has the entries added and removed by other processes
+            entries = {entry['path']: entry for entry in self._load()}
+            entries[storename] = {
+                'survey': survey, 'path': storename, 'ra': ra, 'dec': dec,
+                'halfwidth': halfwidth, 'pixscale': pixscale,
+            }
+            self.entries = self._evict(list(entries.values()), storename)
+            self._save()
+
+    def _evict(self, entries, keep):
+        ### drop the least recently used images (and the missing ones) until the store fits in `maxbytes`
+        stored = []
+        for entry in entries:
+            try:
+                stat = os.stat(os.path.join(self.storedir, entry['path']))
+            except OSError:
+                continue
+            stored.append((entry['path'] == keep, stat.st_mtime, stat.st_size, entry))
+
+        total = sum(size for kept, mtime, size, entry in stored)
+        removed = set()
+        for kept, mtime, size, entry in sorted(stored, key=lambda item: item[:2]):
+            if total <= self.maxbytes or kept:
+                break
+            try:
+                os.remove(os.path.join(self.storedir, entry['path']))
+            except OSError:
+                pass
+            total -= size
+            removed.add(entry['path'])
+        return [entry for kept, mtime, size, entry in stored if entry['path'] not in removed]
+
+archive_store = None
+
+def enable_archive_store(storedir, maxbytes=4*1024**3, margin=1.):
+    '''
+    Share the archival images downloaded by `download_archival` between all sources.
+    Pass `storedir=None` to disable it
+
+    Params:
+    ----------
+    storedir: str or NoneType
+        folder of the shared store
+    maxbytes: int, 4GB by default
+        maximum size of the stored images
+    margin: float, 1 by default
+        extra width of the downloaded images, as a fraction of the requested width
+
+    Returns:
+    ----------
+    archive_store: ArchiveStore or NoneType
+    '''
+    global archive_store
+    archive_store = ArchiveStore(storedir, maxbytes, margin) if storedir is not None else None
+    return archive_store
+
+### Cache of the files downloaded by this package
+def _is_complete_fits(fitspath):
+    '''
+    Check that a file is a fits file holding all the data its headers announce
+    '''
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with fits.open(fitspath, lazy_load_hdus=False) as hdulist:
+                hdulist[-1].data # reading the data of a truncated file fails or warns
+    except Exception:
+        return False
+    return not any('truncated' in str(warning.message) for warning in caught)
+
+class DownloadCache:
+    '''
+    On-disk cache of downloaded archival images, keyed by the request (survey, position, radius),
+    so that the same image is not downloaded again by other sources, runs or processes.
+    Files are written atomically and the least recently used ones are removed when the cache
+    grows over `maxbytes`, files not used for `maxage` seconds are removed as well
+    '''
+
+    def __init__(self, cachedir, maxbytes=2*1024**3, maxage=30*86400):
+        '''
+        Params:
+        ----------
+        cachedir: str
+            folder of the cached files
+        maxbytes: int, 2GB by default
+            maximum size of the cache folder
+        maxage: float or NoneType, 30 days by default
+            files not used for longer than this (in seconds) are removed, never if None
+        '''
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cachedir, hashlib.sha1(key.encode()).hexdigest() + '.fits')
+
+    def _expired(self, mtime):
+        return self.maxage is not None and time.time() - mtime > self.maxage
+
+    def get(self, key, geturl, timeout=120):
+        '''
+        Get the local path of the file for `key`, download it from `geturl()` if it is not cached
+
+        Params:
+        ----------
+        key: str
+            identifier of the request
+        geturl: function
+            called without arguments to get the url, only when the file is not cached
+        timeout: float
+            timeout (seconds) of the download
+
+        Returns:
+        ----------
+        cachepath: str
+        '''
+        cachepath = self._path(key)
+        try:
+            if not self._expired(os.stat(cachepath).st_mtime):
+                os.utime(cachepath)
+                with self._lock:
+                    self.hits += 1
+                return cachepath
+        except OSError: # not cached, or removed by another process
+            pass
+
+        with self._lock:
+            self.misses += 1
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir, exist_ok=True)
+
+        tmppath = f'{cachepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            url = geturl()
+            with requests.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True # undo Content-Encoding: gzip
+                with open(tmppath, 'wb') as fp:
+                    shutil.copyfileobj(response.raw, fp)
+            ### only complete fits files are cached (not error pages or truncated downloads)
+            if not _is_complete_fits(tmppath):
+                raise OSError(f'{url} did not return a complete fits file')
+            os.replace(tmppath, cachepath)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+        self._evict()
+        return cachepath
+
+    def discard(self, key):
+        '''
+        Remove the cached file of `key`, e.g. when it can not be opened
+        '''
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        with self._lock:
+            cached = []
+            for filename in os.listdir(self.cachedir):
+                if not filename.endswith('.fits'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cachedir, filename))
+                except OSError:
+                    continue
+                cached.append((stat.st_mtime, stat.st_size, filename))
+
+            total = sum(size for mtime, size, filename in cached)
+            for mtime, size, filename in sorted(cached):
+                if total <= self.maxbytes and not self._expired(mtime):
+                    break
+                try:
+                    os.remove(os.path.join(self.cachedir, filename))
+                except OSError:
+                    pass
+                total -= size
+
+    def clear(self):
+        '''
+        Remove all cached files and reset the counters
+        '''
+        with self._lock:
+            if os.path.exists(self.cachedir):
+                for filename in os.listdir(self.cachedir):
+                    if filename.endswith('.fits'):
+                        try:
+                            os.remove(os.path.join(self.cachedir, filename))
+                        except OSError:
+                            pass
+            self.hits = 0
+            self.misses = 0
+
+download_cache = DownloadCache(os.path.join(os.path.expanduser('~'), '.cache', 'VASTTransient'))
+
+def set_download_cache(cachedir, maxbytes=2*1024**3, maxage=30*86400):
+    '''
+    Change the folder and limits of the cache used by `download_archival`.
+    Pass `cachedir=None` to download without caching
+
+    Params:
+    ----------
+    cachedir: str or NoneType
+        folder of the cached files
+    maxbytes: int, 2GB by default
+        maximum size of the cache folder
+    maxage: float or NoneType, 30 days by default
+        files not used for longer than this (in seconds) are removed
+
+    Returns:
+    ----------
+    download_cache: DownloadCache or NoneType
+    '''
+    global download_cache
+    download_cache = DownloadCache(cachedir, maxbytes, maxage) if cachedir is not None else None
+    return download_cache
+
 def download_archival(ra,dec,radius,survey,savedir, cache=True):
     '''
     Function for downloading archival fits data
@@ -114,36 +544,74 @@ def download_archival(ra,dec,radius,survey,savedir, cache=True):
         radius of the fits file in arcsec
     survey: str
         name of survey, values accepted are those for SkyView and `Skymapper`, `PanSTARRS`
-    
+
+    The image is cut from `archive_store` (see `enable_archive_store`) if a stored
+    image contains it, and downloaded images are added to the store.
+    Downloads go through `download_cache` (see `set_download_cache`) unless `cache` is False
+
+    Returns:
+    ----------
+    status: str
+        `exists` (already in savedir), `stored` (cut from the archive store) or `downloaded`.
+        Failures (no image, timeouts, HTTP errors...) raise their exception
     '''
     survey = survey.replace(' ', '_')
     fits_fname = '{}_{}.fits'.format(survey, radius)
     fitspath = os.path.join(savedir, fits_fname)
 
     if os.path.exists(fitspath):
-        return 0
+        return 'exists'
 
+    if archive_store is not None and archive_store.serve(survey.replace('_', ' '), ra, dec, radius, fitspath):
+        return 'stored'
 
+    ### a wider image (same pixel scale) for the store, so that it serves the neighbours
+    pad = 1. + archive_store.margin if archive_store is not None else 1.
     if survey == 'PanSTARRS':
-        urls = geturl_PanSTARRS(ra, dec, size=radius*4,filters="g",format='fits')
-        if len(urls) == 0:
-            return -1
-        hdulist = fits.open(urls[0]); hdulists = [hdulist]
+        def geturl():
+            urls = geturl_PanSTARRS(ra, dec, size=int(round(radius*4*pad)),filters="g",format='fits')
+            if len(urls) == 0:
+                raise ValueError('no PanSTARRS image found')
+            return urls[0]
     elif survey == 'SkyMapper':
-        try:
-            url = geturl_skymapper(ra, dec, radius)
-        except:
-            return -1
-        hdulist = fits.open(url); hdulists = [hdulist]
+        def geturl():
+            return geturl_skymapper(ra, dec, radius*pad)
     else:
+        def geturl():
+            urls = SkyView.get_image_list(
+                position=f'{ra} {dec}',survey=[survey], radius=radius*pad*u.arcsec, pixels=int(round(300*pad))
+            )
+            if len(urls) == 0:
+                raise ValueError(f'no {survey} image found'.replace('_', ' '))
+            return urls[0]
+
+    if cache and download_cache is not None:
+        key = f'{survey}|{ra:.6f}|{dec:.6f}|{radius}' + (f'|{pad:g}' if pad != 1. else '')
         try:
-            hdulists = SkyView.get_images(position=f'{ra} {dec}',survey=[survey], radius=radius*u.arcsec,cache=cache)
-        except:
-            return -1
-    ### format survey name
-    
-    _save_hdulist(hdulists[0], fitspath)
-    return 0
+            hdulist = fits.open(download_cache.get(key, geturl))
+        except OSError:
+            ### do not keep serving a broken file
+            download_cache.discard(key)
+            raise
+    else:
+        hdulist = fits.open(geturl(), cache=False)
+
+    if archive_store is None:
+        _save_hdulist(hdulist, fitspath)
+        hdulist.close()
+        return 'downloaded'
+
+    ### store the wide image, and cut the request from it
+    widepath = f'{fitspath}.{os.getpid()}.{threading.get_ident()}.wide.fits'
+    try:
+        _save_hdulist(hdulist, widepath)
+        hdulist.close()
+        archive_store.add(survey.replace('_', ' '), widepath)
+        _cut_archival(widepath, survey.replace('_', ' '), ra, dec, radius, fitspath)
+    finally:
+        if os.path.exists(widepath):
+            os.remove(widepath)
+    return 'downloaded'
 
 # these functions for multiple downloading
 def _parse_downloadlist(survey_radius):
@@ -167,9 +635,46 @@ def _parse_downloadlist(survey_radius):
             download_list.append([survey, radius])
     return download_list
 
-def download_archival_multithreading(ra, dec, survey_radius, savedir, maxthreads=8, cache=True):
+### maximum number of simultaneous downloads from each service
+service_concurrency = {'SkyView': 8, 'PanSTARRS': 4, 'SkyMapper': 2}
+
+def _download_service(survey):
+    '''
+    Name of the service a survey is downloaded from (`SkyView`, `PanSTARRS` or `SkyMapper`)
+    '''
+    if survey in ['PanSTARRS', 'SkyMapper']:
+        return survey
+    return 'SkyView'
+
+def _download_job(ra, dec, radius, survey, savedir, cache=True):
+    '''
+    Run `download_archival` for one (survey, radius) and report what happened
+
+    Returns:
+    ----------
+    result: dict
+        with keys survey, radius, path, status (`exists`, `stored`, `downloaded` or `failed`),
+        error (None or the exception raised by the failed download) and time (seconds spent)
+    '''
+    fitspath = os.path.join(savedir, '{}_{}.fits'.format(survey.replace(' ', '_'), radius))
+    result = {'survey': survey, 'radius': radius, 'path': fitspath, 'status': 'exists', 'error': None, 'time': 0.}
+    if os.path.exists(fitspath):
+        return result
+
+    start = time.time()
+    try:
+        result['status'] = download_archival(ra, dec, radius, survey, savedir, cache)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['time'] = time.time() - start
+    return result
+
+def download_archival_multithreading(ra, dec, survey_radius, savedir, maxthreads=8, cache=True, concurrency=None):
     '''
     Download fits image with multiple threads
+    Jobs are queued per service (see `service_concurrency`), and each service has its own
+    pool of worker threads taking the next job as soon as they are free
 
     Params:
     ----------
@@ -180,35 +685,46 @@ def download_archival_multithreading(ra, dec, survey_radius, savedir, maxthreads
     savedir: str
         directory for saving fits files
     maxthreads: int, 8 by default
-        maximum threads used for downloading simutaneously
+        maximum threads used for downloading simutaneously from one service
+    concurrency: dict or NoneType
+        maximum simultaneous downloads per service, overriding `service_concurrency`
+
+    Returns:
+    ----------
+    results: list of dict
+        one result of `_download_job` for every (survey, radius), in the order of survey_radius
     '''
     download_list = _parse_downloadlist(survey_radius)
-
-    process_args = []
-    thread_args = []
-    for download_pairs in download_list:
-        ### create a list containing all args for threading
-        thread_args.append([ra, dec, download_pairs[1], download_pairs[0], savedir, cache])
-        if len(thread_args) >= maxthreads:
-            process_args.append(thread_args)
-            thread_args = []
-    if len(thread_args) != 0: process_args.append(thread_args)
-
-    # print(process_args)
+    concurrency = dict(service_concurrency, **(concurrency or {}))
+
+    ### one queue of jobs per service
+    jobqueues = {}
+    for i, (survey, radius) in enumerate(download_list):
+        service = _download_service(survey)
+        jobqueues.setdefault(service, queue.Queue()).put((i, survey, radius))
+
+    results = [None] * len(download_list)
+    def _worker(jobqueue):
+        while True:
+            try:
+                i, survey, radius = jobqueue.get_nowait()
+            except queue.Empty:
+                return
+            results[i] = _download_job(ra, dec, radius, survey, savedir, cache)
 
     ### Start threadings
-    for thread_args in process_args:
-        download_threads = []
-        for thread_arg in thread_args:
-            th = threading.Thread(target=download_archival, args=thread_arg)
+    download_threads = []
+    for service, jobqueue in jobqueues.items():
+        nthreads = max(1, min(concurrency.get(service, 1), maxthreads, jobqueue.qsize()))
+        for n in range(nthreads):
+            th = threading.Thread(target=_worker, args=(jobqueue,))
             th.start()
             download_threads.append(th)
 
-        for r in download_threads:
-            r.join()
+    for th in download_threads:
+        th.join()
 
-    ### clear cache
-    clear_download_cache()
+    return results
     
 ### Function for wise color-color plot
 def plot_wise_cc(position, radius=5):
@@ -228,8 +744,7 @@ def plot_wise_cc(position, radius=5):
     if isinstance(position,tuple) or isinstance(position,list):
         position = SkyCoord(*position, unit=u.deg)
 
-    v = Vizier(columns=['*', '+_r'])
-    tablelist = v.query_region(position, radius=radius * u.arcsec, catalog='II/328/allwise')
+    tablelist = query_catalog(position, radius, 'II/328/allwise')
     fig = plt.figure(figsize=(6, 6))
     ax = fig.add_subplot(111)
     
@@ -295,11 +810,63 @@ def get_archival_crossmatch(coord, catalog, radius):
     if isinstance(coord,tuple) or isinstance(coord,list):
         coord = SkyCoord(*coord, unit=u.deg)
 
-    v = Vizier(columns=['*', '+_r'])
-    tablelist = v.query_region(coord, radius=radius*u.arcsec, catalog=catalog)
+    tablelist = query_catalog(coord, radius, catalog)
     if len(tablelist) == 0: return -1
     return tablelist[0][0]
 
+def batch_archival_crossmatch(coords, catalog, radius, chunksize=500):
+    '''
+    Get the nearest matches of many positions from an archival catalogue,
+    with one multi-position Vizier query per chunk of positions
+
+    Params:
+    ----------
+    coords: SkyCoord (array), or a list of (ra, dec)
+        positions of interest
+    catalog: str
+        catalog reference code from Vizier
+    radius: float
+        crossmatch radius in arcsec
+    chunksize: int, 500 by default
+        number of positions per query
+
+    Returns:
+    ----------
+    matches: list
+        nearest match (astropy Row) for each position, or -1 if there is no match
+        (the same as `get_archival_crossmatch`)
+    '''
+    if not isinstance(coords, SkyCoord):
+        coords = SkyCoord([coord[0] for coord in coords], [coord[1] for coord in coords], unit=u.deg)
+    if coords.isscalar:
+        coords = coords.reshape((1,))
+
+    matches = [-1] * len(coords)
+    if catalog in local_catalogs: # cone searches in the local copy
+        for i in range(len(coords)):
+            result = local_catalogs[catalog].cone_search(coords[i], radius)
+            if len(result) > 0:
+                matches[i] = result[0]
+        return matches
+
+    v = Vizier(columns=['*', '+_r'], row_limit=-1)
+    for start in range(0, len(coords), chunksize):
+        chunk = coords[start:start+chunksize]
+        tablelist = v.query_region(chunk, radius=radius*u.arcsec, catalog=catalog)
+        if len(tablelist) == 0: continue
+        table = tablelist[0]
+
+        ### _q is the (1-based) index of the position in the query
+        if '_q' in table.colnames:
+            qindex = np.array(table['_q'], dtype=int) - 1
+        else: # single position
+            qindex = np.zeros(len(table), dtype=int)
+        for row, q in zip(table, qindex):
+            i = start + q
+            if isinstance(matches[i], int) or row['_r'] < matches[i]['_r']:
+                matches[i] = row
+    return matches
+
 def _parse_Vizier_result(r, survey):
     '''
     Parse result from Vizier and output a list contains frequency and its coresponding flux
@@ -397,7 +964,7 @@ def _get_survey_reffreq(survey):
     freqdict = {'SUMSS': 0.843, 'NVSS':1.4, 'TGSS':0.15, 'GLEAM':0.2}
     return freqdict.get(survey)
 
-def get_archival_data(coord, catalogs, fitspath=None, sigma=5):
+def get_archival_data(coord, catalogs, fitspath=None, sigma=5, matches=None):
     '''
     get all archival data from a list of catalogs you provided
 
@@ -411,6 +978,9 @@ def get_archival_data(coord, catalogs, fitspath=None, sigma=5):
         for a non-match, search for any fits file already downloaded and estimate the upperlimit
     sigma: float or int
         upper limit in the final data for a non-detection
+    matches: dict or NoneType
+        precomputed crossmatch (e.g. from `batch_archival_crossmatch`) for each survey,
+        the match or -1 for no match. Vizier is queried for the surveys not in it
 
     Returns:
     ----------
@@ -423,7 +993,10 @@ def get_archival_data(coord, catalogs, fitspath=None, sigma=5):
         yearobs = catalogs[survey][1]
         searchradius = catalogs[survey][2]
 
-        viziertable = get_archival_crossmatch(coord, reference_code, searchradius)
+        if matches is not None and survey in matches:
+            viziertable = matches[survey]
+        else:
+            viziertable = get_archival_crossmatch(coord, reference_code, searchradius)
 
         if isinstance(viziertable, int): # no match found
             if survey == 'AT20G':
@@ -447,6 +1020,53 @@ def get_archival_data(coord, catalogs, fitspath=None, sigma=5):
                 archival_data.append(f'{survey},{freq},{yearobs},{flux},1\n')
     return archival_data
 
+def batch_archival_data(coords, catalogs, sourcepaths, sigma=5, chunksize=500):
+    '''
+    Write the archival flux file (`archival_flux.dat`) of many sources, with one batch
+    crossmatch per catalogue instead of one Vizier query per source and catalogue
+
+    Params:
+    ----------
+    coords: SkyCoord (array), or a list of (ra, dec)
+        positions of the sources
+    catalogs: dict
+        the same as in `get_archival_data`
+    sourcepaths: list of str
+        folder of each source, the flux file is written there and the
+        non-detection images are searched in its `img/` folder
+    sigma: float or int
+        upper limit in the final data for a non-detection
+    chunksize: int, 500 by default
+        number of positions per Vizier query
+
+    Returns:
+    ----------
+    archival_data: list
+        the lines written for each source
+    '''
+    if not isinstance(coords, SkyCoord):
+        coords = SkyCoord([coord[0] for coord in coords], [coord[1] for coord in coords], unit=u.deg)
+
+    ### crossmatch all sources with each catalogue
+    survey_matches = {}
+    for survey in catalogs:
+        reference_code = catalogs[survey][0]
+        searchradius = catalogs[survey][2]
+        survey_matches[survey] = batch_archival_crossmatch(coords, reference_code, searchradius, chunksize)
+
+    archival_data = []
+    for i, sourcepath in enumerate(sourcepaths):
+        matches = {survey: survey_matches[survey][i] for survey in catalogs}
+        sourcedata = get_archival_data(
+            coords[i], catalogs,
+            fitspath=os.path.join(sourcepath, 'img/'),
+            sigma=sigma, matches=matches,
+        )
+        with open(os.path.join(sourcepath, 'archival_flux.dat'), 'w') as fp:
+            fp.writelines(sourcedata)
+        archival_data.append(sourcedata)
+    return archival_data
+
 def query_simbad(coord, radius=40):
     '''
     Query result from simbad
@@ -2,6 +2,8 @@
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.nddata import Cutout2D
+from astropy.nddata.utils import NoOverlapError
+from astropy.wcs.utils import proj_plane_pixel_scales
 from astropy.coordinates import SkyCoord
 from astropy.stats import SigmaClip
 from astropy import units as u
@@ -11,10 +13,314 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-from astroquery.vizier import Vizier
+from .localcatalog import query_catalog
 
+import os
 import json
+import hashlib
+import threading
 import pkg_resources
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+### Process-wide cache of opened fits files
+class FITSHandleCache:
+    '''
+    LRU cache of opened (memory mapped) fits files with their header and celestial wcs,
+    so that every image is opened and parsed once per run.
+    Entries are evicted (and their files closed) when there are more than `maxfiles`
+    open files, or the loaded data takes more than `maxbytes`
+    '''
+
+    def __init__(self, maxfiles=32, maxbytes=2*1024**3):
+        '''
+        Params:
+        ----------
+        maxfiles: int, 32 by default
+            maximum number of files kept open
+        maxbytes: int, 2GB by default
+            maximum memory of the data loaded through `data`
+        '''
+        self.maxfiles = maxfiles
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._keylocks = {}
+
+    def _nbytes(self):
+        return sum(entry['nbytes'] for entry in self._entries.values())
+
+    def _evict(self):
+        ### drop the least recently used entries, keep the latest one
+        ### to be called with `_lock` held, the dropped entries are closed by `_close` after releasing it
+        evicted = []
+        while len(self._entries) > 1 and (len(self._entries) > self.maxfiles or self._nbytes() > self.maxbytes):
+            key, entry = self._entries.popitem(last=False)
+            evicted.append(entry)
+        return evicted
+
+    def _close(self, entries):
+        ### wait for the readers of each entry, then close its file
+        for entry in entries:
+            with entry['lock']:
+                entry['closed'] = True
+                entry['hdulist'].close()
+
+    def open(self, fitspath, index=0):
+        '''
+        Get the cache entry of a fits file, open it if it is not cached or changed on disk
+
+        Params:
+        ----------
+        fitspath: str
+            Path for the fits file
+        index: int, 0 by default
+            Index of the hdu
+
+        Returns:
+        ----------
+        entry: dict
+            with hdulist, header, wcs (celestial), data (None if not loaded), lock
+            (to be held while reading from the hdulist) and closed (True once the
+            entry is evicted and its hdulist closed, get a new entry then)
+        '''
+        key = (os.path.abspath(fitspath), index)
+        stat = os.stat(fitspath)
+        stat = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._cached(key, stat)
+            if entry is not None:
+                return entry
+            keylock = self._keylocks.setdefault(key, threading.Lock())
+
+        ### open and parse the file without blocking other files, only once per file
+        with keylock:
+            with self._lock:
+                entry = self._cached(key, stat)
+                if entry is not None:
+                    return entry
+
+            hdulist = fits.open(fitspath, memmap=True)
+            header = hdulist[index].header
+            entry = dict(
+                hdulist=hdulist, header=header, wcs=WCS(header).celestial, data=None,
+                nbytes=len(header) * 80, stat=stat, lock=threading.Lock(), closed=False,
+            )
+
+            with self._lock:
+                self.misses += 1
+                evicted = [self._entries.pop(key)] if key in self._entries else []
+                self._entries[key] = entry
+                evicted += self._evict()
+        self._close(evicted)
+        return entry
+
+    def _cached(self, key, stat):
+        ### the valid cached entry of `key` or None, to be called with `_lock` held
+        entry = self._entries.get(key)
+        if entry is None or entry['stat'] != stat:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def section(self, fitspath, index, key):
+        '''
+        Read a section of the data of a fits file, `key` is the index of hdu.section
+        '''
+        while True:
+            entry = self.open(fitspath, index)
+            with entry['lock']:
+                if not entry['closed']:
+                    return entry['hdulist'][index].section[key]
+
+    def data(self, fitspath, index=0):
+        '''
+        Full data of a fits file, loaded once and counted against `maxbytes`
+        '''
+        while True:
+            entry = self.open(fitspath, index)
+            with entry['lock']:
+                if entry['data'] is not None:
+                    return entry['data']
+                if entry['closed']:
+                    continue
+                data = entry['data'] = np.array(entry['hdulist'][index].data)
+            with self._lock:
+                entry['nbytes'] += data.nbytes
+                evicted = self._evict()
+            self._close(evicted)
+            return data
+
+    def clear(self):
+        '''
+        Close all files and empty the cache
+        '''
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        self._close(entries)
+
+fits_cache = FITSHandleCache()
+
+### Persistent cache of cutouts
+class CutoutCache:
+    '''
+    On-disk cache of cutouts, keyed by (image path, mtime, size, ra, dec, hdu index) and radius.
+    Every cutout is saved as `<hash>/<radius>.npz` in `cachedir` with its data and wcs header,
+    a cutout with a larger radius at the same position serves smaller requests.
+    The least recently used files are removed when the cache grows over `maxbytes`
+    '''
+
+    def __init__(self, cachedir, maxbytes=1024**3):
+        '''
+        Params:
+        ----------
+        cachedir: str
+            folder of the cached cutouts
+        maxbytes: int, 1GB by default
+            maximum size of the cache folder
+        '''
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        self._total = sum(size for mtime, size, path in self._files())
+
+    def _hashdir(self, fitspath, index, ra, dec):
+        stat = os.stat(fitspath)
+        key = f'{os.path.abspath(fitspath)}|{stat.st_mtime}|{stat.st_size}|{ra:.7f}|{dec:.7f}|{index}'
+        return os.path.join(self.cachedir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _files(self):
+        ### (mtime, size, path) of every cached cutout
+        files = []
+        for hashentry in os.scandir(self.cachedir):
+            if not hashentry.is_dir():
+                continue
+            try:
+                entries = list(os.scandir(hashentry.path))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith('.npz'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def get(self, fitspath, index, ra, dec, radius):
+        '''
+        Get a cutout from the cache, None if there is no cached cutout with a radius >= `radius`
+
+        Returns:
+        ----------
+        cutout: Cutout2D object or NoneType
+        '''
+        hashdir = self._hashdir(fitspath, index, ra, dec)
+        radii = []
+        try:
+            filenames = os.listdir(hashdir)
+        except OSError: # nothing cached at this position
+            filenames = []
+        for filename in filenames:
+            if filename.endswith('.npz'):
+                cachedradius = float(filename[:-4])
+                if cachedradius >= radius:
+                    radii.append((cachedradius, filename))
+        if len(radii) == 0:
+            self.misses += 1
+            return None
+
+        ### the smallest cutout that covers the request
+        cachepath = os.path.join(hashdir, min(radii)[1])
+        try:
+            with np.load(cachepath) as cached:
+                data = cached['data']
+                wcs = WCS(fits.Header.fromstring(str(cached['header'])))
+            os.utime(cachepath)
+        except (OSError, ValueError, KeyError): # removed or broken by another process
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        coord = SkyCoord(ra, dec, unit=u.deg)
+        size = (radius*u.deg / 1800., radius*u.deg / 1800.)
+        return Cutout2D(data, coord, size, wcs=wcs)
+
+    def put(self, fitspath, index, ra, dec, radius, cutout):
+        '''
+        Save a cutout to the cache, and evict the least recently used cutouts if it is over `maxbytes`
+        '''
+        hashdir = self._hashdir(fitspath, index, ra, dec)
+        cachepath = os.path.join(hashdir, f'{radius:g}.npz')
+        tmppath = f'{cachepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+        for attempt in range(2):
+            os.makedirs(hashdir, exist_ok=True)
+            try:
+                with open(tmppath, 'wb') as fp:
+                    np.savez_compressed(fp, data=cutout.data, header=cutout.wcs.to_header().tostring())
+                break
+            except FileNotFoundError: # folder removed by an eviction in another process
+                if attempt == 1:
+                    raise
+        size = os.path.getsize(tmppath)
+        replaced = os.path.getsize(cachepath) if os.path.exists(cachepath) else 0
+        os.replace(tmppath, cachepath)
+
+        with self._lock:
+            self._total += size - replaced
+            if self._total <= self.maxbytes:
+                return
+            self._evict()
+
+    def _evict(self):
+        ### to be called with `_lock` held, also resynchronise the size with the files written by other processes
+        cached = self._files()
+        total = sum(size for mtime, size, path in cached)
+        for mtime, size, path in sorted(cached):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError: # other cutouts left at this position
+                pass
+        self._total = total
+
+cutout_cache = None
+
+def enable_cutout_cache(cachedir, maxbytes=1024**3):
+    '''
+    Keep the cutouts made by FITSIMAGE.cutout (and so all plotting functions) in an
+    on-disk cache, reused by later runs. Pass `cachedir=None` to disable it
+
+    Params:
+    ----------
+    cachedir: str or NoneType
+        folder of the cached cutouts
+    maxbytes: int, 1GB by default
+        maximum size of the cache folder
+
+    Returns:
+    ----------
+    cutout_cache: CutoutCache or NoneType
+    '''
+    global cutout_cache
+    cutout_cache = CutoutCache(cachedir, maxbytes) if cachedir is not None else None
+    return cutout_cache
 
 ### Handle the fits file, Perform the cutout
 class FITSIMAGE:
@@ -24,7 +330,8 @@ class FITSIMAGE:
 
     def __init__(self, fitspath, index = 0):
         '''
-        Initiate function for FITSIMAGE class
+        Initiate function for FITSIMAGE class, nothing is read here. The header and wcs are
+        read when needed (once per run, through `fits_cache`)
 
         Params:
         ----------
@@ -33,17 +340,62 @@ class FITSIMAGE:
         index: int, 0 by default
             Index of the data to extract from
         '''
+        if not os.path.exists(fitspath):
+            raise FileNotFoundError(f'{fitspath} does not exist')
+        self.fitspath = fitspath
+        self.index = index
+
+    @property
+    def header(self):
+        return fits_cache.open(self.fitspath, self.index)['header']
+
+    @property
+    def wcs(self):
+        return fits_cache.open(self.fitspath, self.index)['wcs']
+
+    @property
+    def data(self):
+        '''
+        Full data of the image, only read when it is accessed
+        '''
+        return fits_cache.data(self.fitspath, self.index)
 
-        with fits.open(fitspath) as hdu:
-            self.data = hdu[index].data
-            self.header = hdu[index].header
+    def _pixel_bbox(self, coord, radius):
+        '''
+        Work out the pixel bounding box of a cutout, with a margin of 2 pixels
 
-        self.wcs = WCS(self.header).celestial
+        Params:
+        ----------
+        coord: astropy.coordinates.SkyCoord
+            centre of the cutout
+        radius: float
+            radius of the cutout, in arcsec
 
+        Returns:
+        ----------
+        (ymin, ymax, xmin, xmax): tuple of int, clipped to the image
+        '''
+        nx, ny = self.header['NAXIS1'], self.header['NAXIS2']
+        x, y = self.wcs.world_to_pixel(coord)
+        if not (np.isfinite(x) and np.isfinite(y)):
+            raise NoOverlapError('Position is outside of the image projection')
+
+        ### half size of the cutout in pixels along each axis
+        halfsize = (radius / 3600.) / proj_plane_pixel_scales(self.wcs) + 2
+        xmin = max(int(np.floor(x - halfsize[0])), 0)
+        xmax = min(int(np.ceil(x + halfsize[0])) + 1, nx)
+        ymin = max(int(np.floor(y - halfsize[1])), 0)
+        ymax = min(int(np.ceil(y + halfsize[1])) + 1, ny)
+        if xmin >= xmax or ymin >= ymax:
+            raise NoOverlapError('Arrays do not overlap.')
+        return ymin, ymax, xmin, xmax
 
     def cutout(self, ra, dec, radius=20.):
         '''
         Make a cutout with a radius of `radius` arcsec centered at coordinate (ra, dec)
+        Only the pixels around the position are read from the file, degenerate
+        (Stokes/frequency) axes take their first plane. The on-disk `cutout_cache`
+        is checked first if it is enabled (see `enable_cutout_cache`)
 
         Params:
         ----------
@@ -56,9 +408,195 @@ class FITSIMAGE:
         ----------
         cutout: Cutout2D object
         '''
+        if cutout_cache is not None:
+            cutout = cutout_cache.get(self.fitspath, self.index, ra, dec, radius)
+            if cutout is not None:
+                return cutout
+
         coord = SkyCoord(ra, dec, unit=u.deg)
         size = (radius*u.deg / 1800., radius*u.deg / 1800.)
-        return Cutout2D(np.squeeze(self.data), coord, size, wcs=self.wcs)
+
+        ### read the section around the position only
+        ymin, ymax, xmin, xmax = self._pixel_bbox(coord, radius)
+        naxis = self.header['NAXIS']
+        section = fits_cache.section(
+            self.fitspath, self.index, (0,)*(naxis - 2) + (slice(ymin, ymax), slice(xmin, xmax))
+        )
+
+        cutout = Cutout2D(section, coord, size, wcs=self.wcs[ymin:ymax, xmin:xmax])
+        if cutout_cache is not None:
+            cutout_cache.put(self.fitspath, self.index, ra, dec, radius, cutout)
+        return cutout
+
+### Batch cutouts for many sources
+def cutout_filename(imageid, radius, imagepath_col='path'):
+    '''
+    Name of the cutout file of an image written by `batch_cutouts`
+
+    Params:
+    ----------
+    imageid: int or str
+        id of the image (index of the images dataframe)
+    radius: int or float
+        radius of the cutout, in arcsec
+    imagepath_col: str
+        column of the images dataframe the cutout was made from
+
+    Returns:
+    ----------
+    filename: str
+    '''
+    return f'{imagepath_col}_{imageid}_{int(radius)}.fits'
+
+def write_cutout(cutout, fitspath, header=None):
+    '''
+    Write a Cutout2D object to a fits file
+
+    Params:
+    ----------
+    cutout: Cutout2D object
+    fitspath: str
+        path of the output fits file
+    header: astropy.io.fits.Header or NoneType
+        header of the original image, the unit and beam are copied from it
+    '''
+    cutoutheader = cutout.wcs.to_header()
+    if header is not None:
+        for key in ('BUNIT', 'BMAJ', 'BMIN', 'BPA'):
+            if key in header:
+                cutoutheader[key] = header[key]
+    fits.writeto(fitspath, cutout.data, cutoutheader, overwrite=True)
+
+def batch_cutouts(requests, measurements, images, cutoutdir, imagepath_cols=('path',), imageid_col='image_id', source_col='source'):
+    '''
+    Make the cutouts of many sources at once. The requests are grouped by image,
+    so every image is opened once and all sources in it are cut in one pass.
+    The cutouts are written to `cutoutdir/<source_id>/`, named by `cutout_filename`,
+    and can be used by `plot_multiepoch_cutout` (and `PipelineSource`) with `cutoutdir`
+
+    Params:
+    ----------
+    requests: pandas.DataFrame
+        dataframe with columns source_id, ra, dec and radius (in arcsec),
+        one row per cutout size of a source
+    measurements: pandas.DataFrame
+        dataframe contains the measurements of the requested sources, with
+        the source id in `source_col` and the image id in `imageid_col`
+    images: pandas.DataFrame
+        dataframe contains all images information, indexed by image id
+    cutoutdir: str
+        base folder of the cutouts
+    imagepath_cols: list or tuple, ('path',) by default
+        columns in images dataframe with the image paths to cut, e.g. ('path', 'Vpath')
+    imageid_col: str
+        column that saves imageid in measurements dataframe
+    source_col: str
+        column that saves the source id in measurements dataframe
+
+    Returns:
+    ----------
+    ncutouts: int
+        number of cutouts written
+    '''
+    ### every (image, source, radius) to cut
+    jobs = measurements[[source_col, imageid_col]].drop_duplicates().merge(
+        requests, left_on=source_col, right_on='source_id'
+    )
+
+    ncutouts = 0
+    for imageid, group in jobs.groupby(imageid_col):
+        for imagepath_col in imagepath_cols:
+            imagepath = images.loc[imageid][imagepath_col]
+            if pd.isna(imagepath): # e.g. no Vpath for this image
+                continue
+            try: # handle fits file doesnot exist or can not be read, skip the cutouts of this image only
+                fitsimage = FITSIMAGE(imagepath)
+                fitsimage.header; fitsimage.wcs
+            except Exception:
+                continue
+
+            for row in group.itertuples():
+                try: # handle source outside of the image, or any other error of this cutout
+                    cutout = fitsimage.cutout(row.ra, row.dec, row.radius)
+                except Exception:
+                    continue
+
+                sourcedir = os.path.join(cutoutdir, str(row.source_id))
+                if not os.path.exists(sourcedir):
+                    os.makedirs(sourcedir)
+                write_cutout(
+                    cutout,
+                    os.path.join(sourcedir, cutout_filename(imageid, row.radius, imagepath_col)),
+                    fitsimage.header
+                )
+                ncutouts += 1
+
+    return ncutouts
+
+### Normalisation of the images
+_zscale_limits = {}
+
+def sample_pixels(arrays, nsamples=1000):
+    '''
+    Strided sample of the finite pixels of one or many arrays, each array
+    contributes about the same number of pixels
+
+    Params:
+    ----------
+    arrays: list of numpy.ndarray
+    nsamples: int, 1000 by default (as ZScaleInterval)
+        total number of pixels to sample
+
+    Returns:
+    ----------
+    sample: numpy.ndarray
+    '''
+    quota = max(1, nsamples // max(1, len(arrays)))
+    samples = []
+    for data in arrays:
+        flat = np.ravel(data)
+        sample = flat[::max(1, flat.size // quota)]
+        samples.append(sample[np.isfinite(sample)])
+    return np.concatenate(samples) if len(samples) > 0 else np.array([])
+
+def zscale_norm(arrays, key=None, nsamples=1000):
+    '''
+    ZScale normalisation from a pixel sample of one or many arrays (pooled, for a common scale)
+
+    Params:
+    ----------
+    arrays: numpy.ndarray or list of numpy.ndarray
+        data to be plotted with this normalisation
+    key: hashable or NoneType
+        key for caching the limits, e.g. (ra, dec, radius, stokes), the limits
+        are computed once per key. Not cached if None
+    nsamples: int, 1000 by default (as ZScaleInterval)
+        number of pixels used to estimate the limits
+
+    Returns:
+    ----------
+    norms: astropy.visualization.ImageNormalize
+    '''
+    if key is not None and key in _zscale_limits:
+        vmin, vmax = _zscale_limits[key]
+        return ImageNormalize(vmin=vmin, vmax=vmax)
+
+    if isinstance(arrays, np.ndarray):
+        arrays = [arrays]
+    sample = sample_pixels(arrays, nsamples)
+    if sample.size == 0: # nothing to scale
+        return ImageNormalize()
+    vmin, vmax = ZScaleInterval(n_samples=max(1, sample.size)).get_limits(sample)
+
+    if key is not None:
+        _zscale_limits[key] = (vmin, vmax)
+    return ImageNormalize(vmin=vmin, vmax=vmax)
+
+def clear_zscale_cache():
+    '''
+    Forget the cached limits of zscale_norm
+    '''
+    _zscale_limits.clear()
 
 ### Functions for plotting
 def plot_fits(data, ax, norms=None, **kwargs):
@@ -72,6 +610,7 @@ def plot_fits(data, ax, norms=None, **kwargs):
     ax: matplotlib.axis
         Axis to be plotted on
     norms: astropy.visualization.ImageNormalize or Nonetype
+        ZScale normalisation from a sample of data (see zscale_norm) if None
     **kwargs:
         arguments passed to plt.imshow function
 
@@ -84,7 +623,7 @@ def plot_fits(data, ax, norms=None, **kwargs):
 
     ### set Zscale normalization
     if not isinstance(norms,ImageNormalize):
-        norms = ImageNormalize(data,interval=ZScaleInterval())
+        norms = zscale_norm(data)
 
     im = ax.imshow(data,norm=norms,**kwargs)
 
@@ -186,8 +725,7 @@ def plot_wise_cc(position, radius=5):
     if isinstance(position,tuple) or isinstance(position,list):
         position = SkyCoord(*position, unit=u.deg)
 
-    v = Vizier(columns=['*', '+_r'])
-    tablelist = v.query_region(position, radius=radius * u.arcsec, catalog='II/328/allwise')
+    tablelist = query_catalog(position, radius, 'II/328/allwise')
     fig = plt.figure(figsize=(6, 6))
     ax = fig.add_subplot(111)
     
@@ -255,7 +793,42 @@ def _get_figure_layout(numaxes, ncols, colwidth=5, rowwidth=5):
     figsize = (ncols*colwidth, nrows*rowwidth)
     return subplot_layout, figsize
 
-def plot_multiepoch_cutout(ra, dec, measurements, images, radius=300, imagepath_col='path', imageid_col='image_id', time_col='time', samescale=True):
+def _load_cutout(imagepath, ra, dec, radius):
+    '''
+    Make a cutout from imagepath, None if the file does not exist or can not be cut
+    '''
+    try: # handle fits file doesnot exist
+        fitsimage = FITSIMAGE(imagepath)
+        return fitsimage.cutout(ra, dec, radius)
+    except:
+        return None
+
+def load_cutouts(ra, dec, imagepaths, radius, maxworkers=8):
+    '''
+    Make the cutouts of a position from many images in a bounded thread pool
+
+    Params:
+    ----------
+    ra, dec: float
+        position of the source
+    imagepaths: list
+        paths of the images
+    radius: int or float
+        radius of the cutout, in arcsec
+    maxworkers: int, 8 by default
+        maximum number of threads reading the images
+
+    Returns:
+    ----------
+    cutouts: list
+        Cutout2D objects in the same order as imagepaths, None for the missing ones
+    '''
+    if len(imagepaths) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(maxworkers, len(imagepaths)))) as executor:
+        return list(executor.map(lambda imagepath: _load_cutout(imagepath, ra, dec, radius), imagepaths))
+
+def plot_multiepoch_cutout(ra, dec, measurements, images, radius=300, imagepath_col='path', imageid_col='image_id', time_col='time', samescale=True, cutoutdir=None, maxworkers=8, normkey=None):
     '''
     Plot multi-epoch cutout in one image 
     in order to plot stokesV plot, you can add a row in images dataframe and pass the corresponding stokesV path in imagepath_col
@@ -278,6 +851,15 @@ def plot_multiepoch_cutout(ra, dec, measurements, images, radius=300, imagepath_
         column that saves time of the observation in measurements daraframe
     samescale: bool, True by default
         If the image use the same scale and limit for all subplots or not
+    cutoutdir: str or NoneType
+        folder of the cutouts of the source made by `batch_cutouts`, used instead
+        of the full images when the cutout is there
+    maxworkers: int, 8 by default
+        maximum number of threads loading the cutouts
+    normkey: hashable or NoneType
+        key for caching the scale of the plot, e.g. (source id, radius, stokes),
+        so repeated plots of the same source skip computing it. With samescale the scale
+        is pooled from all epochs, otherwise every epoch has its own scale
 
     Returns:
     ----------
@@ -291,20 +873,35 @@ def plot_multiepoch_cutout(ra, dec, measurements, images, radius=300, imagepath_
     ### start plotting
     fig = plt.figure(figsize=figsize, facecolor='w')
 
-    norms = None; plotcount = 1
+    ### load all cutouts first (I/O bound, in a thread pool)
+    imagepaths = []
     for i, row in sorted_measurements.iterrows():
         imageid = row[imageid_col]
         imagepath = images.loc[imageid][imagepath_col]
-
-        try: # handle fits file doesnot exist
-            fitsimage = FITSIMAGE(imagepath)
-            cutout = fitsimage.cutout(ra, dec, radius)
-        except:
+        if cutoutdir is not None:
+            cutoutpath = os.path.join(cutoutdir, cutout_filename(imageid, radius, imagepath_col))
+            if os.path.exists(cutoutpath):
+                imagepath = cutoutpath
+        imagepaths.append(imagepath)
+    cutouts = load_cutouts(ra, dec, imagepaths, radius, maxworkers=maxworkers)
+
+    ### common scale from a sample of all epochs
+    norms = None
+    if samescale:
+        norms = zscale_norm(
+            [cutout.data for cutout in cutouts if cutout is not None],
+            key=normkey if normkey is None else (normkey, 'all'),
+        )
+
+    ### drawing on the main thread
+    plotcount = 1
+    for (i, row), cutout in zip(sorted_measurements.iterrows(), cutouts):
+        if cutout is None: # fits file doesnot exist
             plotcount += 1
             continue
 
-        if (norms == None) or (samescale == False):
-            norms = ImageNormalize(cutout.data,interval=ZScaleInterval())
+        if samescale == False:
+            norms = zscale_norm(cutout.data, key=normkey if normkey is None else (normkey, row[imageid_col]))
 
         ### add subplot
         ax = fig.add_subplot(*subplot_layout, plotcount, projection=cutout.wcs)
@@ -450,10 +1047,8 @@ def plot_VAST_overlay(ra, dec, imagepath, measurements, images, index=0):
     ----------
     fig, ax
     '''
-    with fits.open(imagepath) as hdulist:
-        data = hdulist[index].data
-        header = hdulist[index].header
-        wcs = WCS(header).celestial
+    data = fits_cache.data(imagepath, index)
+    wcs = fits_cache.open(imagepath, index)['wcs']
 
     fig = plt.figure(figsize=(5, 5), facecolor='w')
     ax = fig.add_subplot(111, projection=wcs)
@@ -0,0 +1,158 @@
+# ztwang201605@gmail.com
+
+from astropy.table import Table, Column
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+from astroquery.vizier import Vizier
+
+import numpy as np
+import bisect
+
+### Local copies of archival catalogues
+class LocalCatalog:
+    '''
+    Catalogue saved as a fits table sorted by declination, for cone searches without Vizier
+    '''
+
+    def __init__(self, catalogpath):
+        '''
+        Initiate function for LocalCatalog class, load a catalogue made by `LocalCatalog.ingest`
+
+        Params:
+        ----------
+        catalogpath: str
+            path for the fits table
+        '''
+        self.catalogpath = catalogpath
+        self.table = Table.read(catalogpath, memmap=True)
+        self.racol = self.table.meta['RACOL']
+        self.deccol = self.table.meta['DECCOL']
+
+        ### positions (in degree) stay memory mapped, only the strip of a search is read
+        self._ra = self.table[self.racol].data
+        self._dec = self.table[self.deccol].data
+
+    @classmethod
+    def ingest(cls, filepath, catalogpath, racol='RAJ2000', deccol='DEJ2000', columns=None, format=None):
+        '''
+        Ingest a downloaded catalogue (e.g. a Vizier table saved as fits/votable/csv) once
+
+        Params:
+        ----------
+        filepath: str
+            path for the downloaded catalogue, any format astropy.table.Table can read
+        catalogpath: str
+            path for the output fits table
+        racol, deccol: str
+            columns of the position, in degree or sexagesimal (e.g. `RAJ2000` of NVSS, hourangle for ra).
+            Sexagesimal positions are converted to degree in the columns `_RAJ2000` and `_DEJ2000`
+        columns: list or NoneType
+            columns to keep, all columns are kept if None
+        format: str or NoneType
+            format passed to astropy.table.Table.read
+
+        Returns:
+        ----------
+        localcatalog: LocalCatalog
+        '''
+        table = Table.read(filepath, format=format) if format is not None else Table.read(filepath)
+        if columns is not None:
+            table = table[list(dict.fromkeys([racol, deccol] + list(columns)))]
+        if not np.issubdtype(np.asarray(table[racol]).dtype, np.number):
+            coords = SkyCoord(table[racol], table[deccol], unit=(u.hourangle, u.deg))
+            table['_RAJ2000'] = coords.ra.deg
+            table['_DEJ2000'] = coords.dec.deg
+            racol, deccol = '_RAJ2000', '_DEJ2000'
+        table = table[np.isfinite(np.asarray(table[deccol], dtype=float))]
+        table.sort(deccol)
+
+        table.meta['RACOL'] = racol
+        table.meta['DECCOL'] = deccol
+        table.write(catalogpath, format='fits', overwrite=True)
+        return cls(catalogpath)
+
+    def cone_search(self, coord, radius):
+        '''
+        Get all sources within `radius` arcsec of `coord`
+
+        Params:
+        ----------
+        coord: SkyCoord, tuple or list
+            position of interest
+        radius: float
+            search radius in arcsec
+
+        Returns:
+        ----------
+        result: astropy.Table
+            matched rows sorted by separation, with the separation (arcsec) in column `_r`
+        '''
+        if isinstance(coord, tuple) or isinstance(coord, list):
+            coord = SkyCoord(*coord, unit=u.deg)
+        ra = coord.icrs.ra.radian; dec = coord.icrs.dec.radian
+        radius_rad = np.radians(radius / 3600.)
+
+        ### candidates in the declination strip, by bisection on the memory mapped column
+        start = bisect.bisect_left(self._dec, np.degrees(dec - radius_rad))
+        end = bisect.bisect_right(self._dec, np.degrees(dec + radius_rad), lo=start)
+        cra = np.radians(np.asarray(self._ra[start:end], dtype=float))
+        cdec = np.radians(np.asarray(self._dec[start:end], dtype=float))
+
+        ### separation with the haversine formula
+        hav = np.sin((cdec - dec) / 2.)**2 + np.cos(dec)*np.cos(cdec)*np.sin((cra - ra) / 2.)**2
+        sep = np.degrees(2. * np.arcsin(np.sqrt(np.clip(hav, 0., 1.)))) * 3600.
+        select = np.nonzero(sep <= radius)[0]
+        order = select[np.argsort(sep[select])]
+
+        result = self.table[start + order]
+        result.add_column(Column(sep[order], name='_r'), 0)
+        return result
+
+### Registered local catalogues, keys are Vizier reference codes
+local_catalogs = {}
+
+def register_local_catalog(catalog, catalogpath):
+    '''
+    Use a local catalogue instead of Vizier for a Vizier reference code
+
+    Params:
+    ----------
+    catalog: str
+        catalog reference code from Vizier, e.g. `VIII/65/nvss` or `II/328/allwise`
+    catalogpath: str or NoneType
+        path for the catalogue made by `LocalCatalog.ingest`, None to go back to Vizier
+
+    Returns:
+    ----------
+    localcatalog: LocalCatalog or NoneType
+    '''
+    if catalogpath is None:
+        return local_catalogs.pop(catalog, None)
+    local_catalogs[catalog] = LocalCatalog(catalogpath)
+    return local_catalogs[catalog]
+
+def query_catalog(coord, radius, catalog):
+    '''
+    Cone search in a catalogue, from the local copy if it is registered, otherwise from Vizier
+
+    Params:
+    ----------
+    coord: SkyCoord
+        position of interest
+    radius: float
+        search radius in arcsec
+    catalog: str
+        catalog reference code from Vizier
+
+    Returns:
+    ----------
+    tablelist: list
+        a list with one astropy.Table sorted by separation (column `_r`), empty if nothing matched
+    '''
+    if catalog in local_catalogs:
+        result = local_catalogs[catalog].cone_search(coord, radius)
+        return [result] if len(result) > 0 else []
+
+    v = Vizier(columns=['*', '+_r'])
+    return v.query_region(coord, radius=radius*u.arcsec, catalog=catalog)
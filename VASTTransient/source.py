@@ -3,6 +3,7 @@
 from .image_data import *
 from .download import *
 from .webpage import *
+from .localcatalog import *
 
 from vasttools.query import Query
 
@@ -10,7 +11,7 @@ class PipelineSource:
     '''
     Run all analysis based on pipeline run result
     '''
-    def __init__(self, coord, measurements, images, sourcepath):
+    def __init__(self, coord, measurements, images, sourcepath, cutoutdir=None):
         '''
         Initiate Function and variable checking for PipelineSource Object
 
@@ -24,6 +25,9 @@ class PipelineSource:
             dataframe contains all images detail
         sourcepath: str
             path for storing all stuff for the source
+        cutoutdir: str or NoneType
+            folder of the cutouts of this source made by `batch_cutouts`
+            (i.e. `<cutoutdir>/<source_id>`), the full images are used if None
         '''
         ### source position
         if isinstance(coord, SkyCoord):
@@ -35,6 +39,7 @@ class PipelineSource:
         ### pipeline products
         self.measurements = measurements
         self.images = images
+        self.cutoutdir = cutoutdir
 
         ### directory
         # base path
@@ -87,7 +92,8 @@ class PipelineSource:
             self.ra, self.dec,
             self.measurements, self.images,
             radius = radius, imagepath_col=imagepath_col,
-            samescale=samescale,
+            samescale=samescale, cutoutdir=self.cutoutdir,
+            normkey=(self.ra, self.dec, radius, imagepath_col),
         )
         if samescale == True:
             self._savefig(fig, os.path.join(self.imagepath, 'StokesI_{}.jpg'.format(int(radius))))
@@ -113,7 +119,8 @@ class PipelineSource:
             self.ra, self.dec,
             self.measurements, self.images,
             radius = radius, imagepath_col=imagepath_col,
-            samescale=samescale,
+            samescale=samescale, cutoutdir=self.cutoutdir,
+            normkey=(self.ra, self.dec, radius, imagepath_col),
         )
         self._savefig(fig, os.path.join(self.imagepath, 'StokesV_{}.jpg'.format(int(radius))))
 
@@ -135,11 +142,14 @@ class PipelineSource:
             maxthreads=32
         )
 
-        clear_download_cache()
-
-    def fetch_archival_data(self):
+    def fetch_archival_data(self, matches=None):
         '''
         Download archival data and save it to a .dat file
+
+        Params:
+        ----------
+        matches: dict or NoneType
+            precomputed crossmatch for each survey (see `get_archival_data`)
         '''
         archivalcatalog_path = pkg_resources.resource_filename(
             __name__, './setups/archival_catalog.json'
@@ -150,7 +160,8 @@ class PipelineSource:
         archivaldata = get_archival_data(
             (self.ra, self.dec),
             archivalcatalog,
-            fitspath=self.imagepath
+            fitspath=self.imagepath,
+            matches=matches,
         )
 
         with open(os.path.join(self.sourcepath, 'archival_flux.dat'), 'w') as fp:
@@ -359,7 +370,7 @@ class VASTSource:
             self.ra, self.dec,
             self.measurements, self.measurements,
             radius = radius, imagepath_col=imagepath_col,
-            samescale=samescale,
+            samescale=samescale, normkey=(self.ra, self.dec, radius, imagepath_col),
         )
         if samescale == True:
             self._savefig(fig, os.path.join(self.imagepath, 'StokesI_{}.jpg'.format(int(radius))))
@@ -385,7 +396,7 @@ class VASTSource:
             self.ra, self.dec,
             self.measurements, self.measurements,
             radius = radius, imagepath_col=imagepath_col,
-            samescale=samescale,
+            samescale=samescale, normkey=(self.ra, self.dec, radius, imagepath_col),
         )
         self._savefig(fig, os.path.join(self.imagepath, 'StokesV_{}.jpg'.format(int(radius))))
 
@@ -407,11 +418,14 @@ class VASTSource:
             maxthreads=32
         )
 
-        clear_download_cache()
-
-    def fetch_archival_data(self):
+    def fetch_archival_data(self, matches=None):
         '''
         Download archival data and save it to a .dat file
+
+        Params:
+        ----------
+        matches: dict or NoneType
+            precomputed crossmatch for each survey (see `get_archival_data`)
         '''
         archivalcatalog_path = pkg_resources.resource_filename(
             __name__, './setups/archival_catalog.json'
@@ -422,7 +436,8 @@ class VASTSource:
         archivaldata = get_archival_data(
             (self.ra, self.dec),
             archivalcatalog,
-            fitspath=self.imagepath
+            fitspath=self.imagepath,
+            matches=matches,
         )
 
         with open(os.path.join(self.sourcepath, 'archival_flux.dat'), 'w') as fp: